@@ -6,8 +6,10 @@ from torch.backends import cudnn
 from torch.utils.data import DataLoader, ConcatDataset
 import numpy as np
 from math import floor
-from copy import copy, deepcopy
+from copy import copy
 from model.icarl import iCaRL
+from model.metrics import RunningMetrics, ResultCollector, loader_size
+from model.profiling import timed
 from data.exemplar import Exemplar
 import random
 
@@ -23,7 +25,7 @@ class owrIncremental(iCaRL):
     self.test_mode = test_mode
     self.threshold = p_threshold
   
-  def train_model(self, num_epochs):
+  def train_model(self, num_epochs, resume=None):
     
     cudnn.benchmark
     
@@ -34,10 +36,15 @@ class owrIncremental(iCaRL):
              'true_labels': [int],
              'val_accuracies': [float for j in range(5)],
              'val_losses': [float for j in range(5)],
+             'epochs_saved': [int for j in range(5)],
+             'profile': [dict for j in range(5)],
              'open_values': [float for j in range(5)],
              'closed_values': [float for j in range(5)]}
+    config = self.run_config(num_epochs)
+    start, logs = self.resume_run(resume, logs, config)
     
-    for g in range(5):
+    for g in range(start, 5):
+      self.timers.reset()
       self.net.to(self.DEVICE)
       if self.old_net is not None: self.old_net = self.old_net.to(self.DEVICE)
       
@@ -45,32 +52,10 @@ class owrIncremental(iCaRL):
       self.optimizer = optim.SGD(self.parameters_to_optimize, lr=self.START_LR, momentum=self.MOMENTUM, weight_decay=self.WEIGHT_DECAY)
       self.scheduler = optim.lr_scheduler.MultiStepLR(self.optimizer, milestones=self.MILESTONES, gamma=self.GAMMA)
       
-      best_acc = 0
-      self.best_net = deepcopy(self.net)
-      
       # augment train_set with exemplars and define DataLoaders for the current group
       self.update_representation(g)
 
-      for epoch in range(num_epochs):
-        e_loss, e_acc = self.train_epoch(g)
-        e_print = epoch + 1
-        print(f"Epoch {e_print}/{num_epochs} LR: {self.scheduler.get_last_lr()}")
-        
-        validate_loss, validate_acc = self.validate(g)
-        g_print = g + 1
-        print(f"Validation accuracy on group {g_print}/5: {validate_acc:.2f}")
-        self.scheduler.step()
-        
-        if self.VALIDATE and validate_acc > best_acc:
-          best_acc = validate_acc
-          self.best_net = deepcopy(self.net)
-          best_epoch = epoch
-          print("Best model updated")
-        print("")
-        
-      print(f"Group {g_print} Finished!")
-      be_print = best_epoch + 1
-      print(f"Best accuracy found at epoch {be_print}: {best_acc:.2f}")
+      e_loss, e_acc, validate_loss, validate_acc = self.train_group(g, num_epochs, 5)
       
       m = self.reduce_exemplar_set()
       self.construct_exemplar_set(self.train_set[g], m, False)
@@ -106,55 +91,50 @@ class owrIncremental(iCaRL):
       logs['group_train_accuracies'][g] = e_acc
       logs['val_losses'][g] = validate_loss
       logs['val_accuracies'][g] = validate_acc
+      logs['epochs_saved'][g] = self.epochs_saved[g]
       logs['test_accuracies'][g] = test_accuracy
 
       if g < 4:
         self.add_output_nodes()
-        self.old_net = deepcopy(self.best_net)
+        self.old_net = self.make_teacher(self.best_net, g)
+      logs['profile'][g] = self.group_profile(g)
+
+      logs['true_labels'] = true_targets
+      logs['predictions'] = predictions
+      self.save_run(resume, g, logs, config)
 
-    logs['true_labels'] = true_targets
-    logs['predictions'] = predictions
     return logs
 
 ################################################################
+  @timed('open_set_test')
   def harmonic_test(self, classes_group_idx):
     open_test_accuracy, open_true_targets, open_predictions, open_unknown_targets, open_unknown_preds, open_unknown_values, open_all_values = self.test_openset(classes_group_idx)
     closed_test_accuracy, closed_true_targets, closed_predictions, closed_unknown_targets, closed_unknown_preds, closed_unknown_values, closed_all_values = self.test_rejection(classes_group_idx)
     mean_acc = 1/((1/(open_test_accuracy+0.0001) + 1/(closed_test_accuracy+0.0001))/2)
     return mean_acc, open_test_accuracy, closed_test_accuracy, open_true_targets, closed_true_targets, open_predictions, closed_predictions, open_unknown_targets, closed_unknown_targets, open_unknown_preds, closed_unknown_preds, open_unknown_values, closed_unknown_values, open_all_values, closed_all_values       
 
+  @timed('open_set_test')
+  @torch.inference_mode()
   def test_openset(self,classes_group_idx):
-    self.best_net.train(False)
+    net = self.evaluation.model(self.best_net)
+    dataloaders = [self.evaluation.loader(self.test_dl[i]) for i in range(5,10)]
     softmax = nn.Softmax(dim=1)
     threshold = self.threshold
-    running_corrects = 0
-    total = 0
-
-    all_preds_with_unknown = torch.tensor([])
-    all_preds_with_unknown = all_preds_with_unknown.type(torch.LongTensor)
-    all_targets = torch.tensor([])
-    all_targets = all_targets.type(torch.LongTensor)
-    all_targets_as_unknown = torch.tensor([])
-    all_targets_as_unknown = all_targets.type(torch.LongTensor)
-    only_unknown_values = torch.tensor([])
-    only_unknown_values = only_unknown_values.type(torch.DoubleTensor)
-    only_unknown_targets = torch.tensor([])
-    only_unknown_targets = only_unknown_targets.type(torch.LongTensor)
-    only_unknown_preds = torch.tensor([])
-    only_unknown_preds = only_unknown_preds.type(torch.LongTensor)
-    all_values = torch.tensor([])
-    all_values = all_values.type(torch.LongTensor)
+    metrics = RunningMetrics(self.DEVICE)
+    # the rejected samples are a subset of the test set, which bounds every result
+    results = ResultCollector(loader_size(*dataloaders), self.DEVICE,
+                              preds_with_unknown=torch.long, targets=torch.long, unknown_values=torch.float64,
+                              unknown_targets=torch.long, unknown_preds=torch.long, values=torch.float32)
     
-    for i in range(5,10):
-      for _, images, labels in self.test_dl[i]:
+    for dataloader in dataloaders:
+      for _, images, labels in self.timers.iterate(dataloader, 'open_set_test'):
         images = images.to(self.DEVICE)
         labels = labels.to(self.DEVICE)
-        total += labels.size(0)
 
-        outputs = self.best_net(images)
+        outputs = net(images)
 
         values, preds = torch.max(softmax(outputs).data, 1)
-        all_values = torch.cat((all_values.to(self.DEVICE),values.to(self.DEVICE)))
+        results.add('values', values)
         below_mask = values < threshold
         #unknowkn_class = classes_group_idx*10+10 #Assign an index to unknown class, for instance at the first iteration we have class from 0 to 9, unkown class will be 10
         unknowkn_class = 100
@@ -164,49 +144,41 @@ class owrIncremental(iCaRL):
         only_unknown_values_batch = values[below_mask]
         
         label_unknow_tensor = torch.tensor([unknowkn_class for _ in range(labels.size(0))]).to(self.DEVICE)
-        all_targets_as_unknown = torch.cat((all_targets_as_unknown.to(self.DEVICE), label_unknow_tensor.to(self.DEVICE)), dim=0) #unknown class will be the true targets for all the test set, since we aspect that the model reject all of them
+        #unknown class will be the true targets for all the test set, since we aspect that the model reject all of them
         
-        running_corrects += torch.sum(preds_with_unknown == label_unknow_tensor.data).data.item()
-        all_targets = torch.cat((all_targets.to(self.DEVICE), labels.to(self.DEVICE)), dim=0)
-        only_unknown_preds = torch.cat((only_unknown_preds.to(self.DEVICE), only_unknown_preds_batch.to(self.DEVICE)), dim=0)
-        only_unknown_targets = torch.cat((only_unknown_targets.to(self.DEVICE), only_unknown_targets_batch.to(self.DEVICE)), dim=0)
-        only_unknown_values = torch.cat((only_unknown_values.to(self.DEVICE), only_unknown_values_batch.to(self.DEVICE)), dim=0)
-        all_preds_with_unknown = torch.cat((all_preds_with_unknown.to(self.DEVICE), preds_with_unknown.to(self.DEVICE)), dim=0)
+        metrics.update(preds_with_unknown, label_unknow_tensor.data)
+        results.add('targets', labels)
+        results.add('unknown_preds', only_unknown_preds_batch)
+        results.add('unknown_targets', only_unknown_targets_batch)
+        results.add('unknown_values', only_unknown_values_batch)
+        results.add('preds_with_unknown', preds_with_unknown)
 
     else:
-      accuracy = running_corrects / float(total)  
-    return accuracy, all_targets, all_preds_with_unknown, only_unknown_targets, only_unknown_preds, only_unknown_values, all_values
+      accuracy = metrics.accuracy()
+    return (accuracy, results.result('targets'), results.result('preds_with_unknown'), results.result('unknown_targets'),
+            results.result('unknown_preds'), results.result('unknown_values'), results.result('values'))
 
 
+  @timed('open_set_test')
+  @torch.inference_mode()
   def test_rejection(self, classes_group_idx):
-      self.best_net.train(False)
+      net = self.evaluation.model(self.best_net)
+      dataloader = self.evaluation.loader(self.test_dl[classes_group_idx])
       softmax = nn.Softmax(dim=1)
       threshold = self.threshold
-      running_corrects = 0
-      total = 0
+      metrics = RunningMetrics(self.DEVICE)
+      results = ResultCollector(loader_size(dataloader), self.DEVICE,
+                                preds_with_unknown=torch.long, targets=torch.long, unknown_values=torch.float64,
+                                unknown_targets=torch.long, unknown_preds=torch.long, values=torch.float32)
 
-      all_preds_with_unknown = torch.tensor([])
-      all_preds_with_unknown = all_preds_with_unknown.type(torch.LongTensor)
-      all_targets = torch.tensor([])
-      all_targets = all_targets.type(torch.LongTensor)
-      only_unknown_values = torch.tensor([])
-      only_unknown_values = only_unknown_values.type(torch.DoubleTensor)
-      only_unknown_targets = torch.tensor([])
-      only_unknown_targets = only_unknown_targets.type(torch.LongTensor)
-      only_unknown_preds = torch.tensor([])
-      only_unknown_preds = only_unknown_preds.type(torch.LongTensor)
-      all_values = torch.tensor([])
-      all_values = all_values.type(torch.LongTensor)
-
-      for _, images, labels in self.test_dl[classes_group_idx]:
+      for _, images, labels in self.timers.iterate(dataloader, 'open_set_test'):
         images = images.to(self.DEVICE)
         labels = labels.to(self.DEVICE)
-        total += labels.size(0)
 
-        outputs = self.best_net(images)
+        outputs = net(images)
 
         values, preds = torch.max(softmax(outputs).data, 1)
-        all_values = torch.cat((all_values.to(self.DEVICE),values.to(self.DEVICE)))
+        results.add('values', values)
         below_mask = values < threshold
         #unknowkn_class = classes_group_idx*10+10 #Assign an index to unknown class, for instance at the first iteration we have class from 0 to 9, unkown class will be 10
         unknowkn_class = 101
@@ -216,18 +188,19 @@ class owrIncremental(iCaRL):
         only_unknown_values_batch = values[below_mask]
 
 
-        running_corrects += torch.sum(preds_with_unknown == labels.data).data.item()
+        metrics.update(preds_with_unknown, labels.data)
 
-        all_targets = torch.cat((all_targets.to(self.DEVICE), labels.to(self.DEVICE)), dim=0)
-        only_unknown_preds = torch.cat((only_unknown_preds.to(self.DEVICE), only_unknown_preds_batch.to(self.DEVICE)), dim=0)
-        only_unknown_targets = torch.cat((only_unknown_targets.to(self.DEVICE), only_unknown_targets_batch.to(self.DEVICE)), dim=0)
-        only_unknown_values = torch.cat((only_unknown_values.to(self.DEVICE), only_unknown_values_batch.to(self.DEVICE)), dim=0)
-        all_preds_with_unknown = torch.cat((all_preds_with_unknown.to(self.DEVICE), preds_with_unknown.to(self.DEVICE)), dim=0)
+        results.add('targets', labels)
+        results.add('unknown_preds', only_unknown_preds_batch)
+        results.add('unknown_targets', only_unknown_targets_batch)
+        results.add('unknown_values', only_unknown_values_batch)
+        results.add('preds_with_unknown', preds_with_unknown)
 
       else:
-        accuracy = running_corrects / float(total)  
+        accuracy = metrics.accuracy()
 
-      return accuracy, all_targets, all_preds_with_unknown, only_unknown_targets, only_unknown_preds, only_unknown_values, all_values
+      return (accuracy, results.result('targets'), results.result('preds_with_unknown'), results.result('unknown_targets'),
+              results.result('unknown_preds'), results.result('unknown_values'), results.result('values'))
 
     
 ###################################################################################################################################
@@ -240,11 +213,10 @@ class owrCosine(owrIncremental):
     self.net.train()
     if self.old_net is not None: self.old_net.train(False)
     if self.best_net is not None: self.best_net.train(False)
-    running_loss = 0
-    running_corrects = 0
-    total = 0
+    self.set_view_epoch(classes_group_idx)
+    metrics = RunningMetrics(self.DEVICE)
 
-    for _, images, labels in self.train_dl[classes_group_idx]:
+    for keys, images, labels in self.timers.iterate(self.teacher_batches(classes_group_idx), 'train'):
       self.optimizer.zero_grad()
 
       images = images.to(self.DEVICE)
@@ -253,30 +225,31 @@ class owrCosine(owrIncremental):
       num_classes = self.net.fc.out_features
       #one_hot_labels = self.onehot_encoding(labels)[:, num_classes-10: num_classes]
       
-      output, loss = self.compute_loss(images, labels, num_classes)
+      with self.autocast():
+        output, loss = self.compute_loss(images, labels, num_classes, keys)
 
-      running_loss += loss.item()
       _, preds = torch.max(output.data, 1)
-      running_corrects += torch.sum(preds == labels.data).data.item()
-      total += labels.size(0)
+      metrics.update(preds, labels.data, loss)
       
       loss.backward()
       self.optimizer.step()
       
     else:
-      epoch_loss = running_loss/len(self.train_dl[classes_group_idx])
-      epoch_acc = running_corrects/float(total)
+      epoch_loss = metrics.mean_loss(len(self.train_dl[classes_group_idx]))
+      epoch_acc = metrics.accuracy()
       
     return epoch_loss, epoch_acc
   
-  def compute_loss(self, images, labels, num_classes):
+  def first_task_objective(self):
+    return 'ce'
+  
+  def compute_loss(self, images, labels, num_classes, keys=None):
     dist_criterion = nn.CosineEmbeddingLoss()
     class_criterion = nn.CrossEntropyLoss()
 
     if self.old_net is not None:
       self.old_net.to(self.DEVICE)    
-      sigmoid = nn.Sigmoid()
-      old_net_output = sigmoid(self.old_net(images))[:, :num_classes-10]
+      old_net_output = self.teacher_outputs(images, keys)[:, :num_classes-10]
       output = self.net(images)
       dist_loss = dist_criterion(output[:,:num_classes-10], old_net_output, torch.ones(images.shape[0]).to(self.DEVICE))
       class_loss = class_criterion(output, labels)
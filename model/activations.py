@@ -0,0 +1,107 @@
+import os
+import tempfile
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, RandomSampler
+from model.teacher import ViewDataset
+
+# Frozen-backbone training. Once conv1 and layer1 (and optionally layer2) are frozen, their
+# output for a (sample, augmentation view) pair never changes, so it is computed once per group
+# and stored in an fp16 array on disk. Training then runs only the upper stages of the network,
+# which read the cached activations through `input_stage` (see ResNet.features). The keys of
+# the activations are the (sample, view) keys of ViewDataset, so the teacher cache can share them.
+
+FROZEN_STAGES = {'layer1': ('conv1', 'bn1', 'layer1'), 'layer2': ('conv1', 'bn1', 'layer1', 'layer2')}
+
+
+def set_input_stage(net, stage):
+  # applies to the network itself and to the networks wrapped by the inference-only teachers
+  for module in net.modules():
+    if hasattr(module, 'input_stage'):
+      module.input_stage = stage
+
+
+def freeze_stages(net, stage):
+  for name in FROZEN_STAGES[stage]:
+    for p in getattr(net, name).parameters():
+      p.requires_grad = False
+
+
+class ActivationDataset(Dataset):
+  # (key, activations, label) of the samples of a ViewDataset, for the view of the current epoch
+
+  def __init__(self, activations, labels, n_views):
+    self.activations = activations
+    self.labels = labels
+    self.n_views = n_views
+    self.epoch = 0
+
+  def set_epoch(self, epoch):
+    self.epoch = epoch
+
+  def __getitem__(self, index):
+    key = index * self.n_views + self.epoch % self.n_views
+    return key, torch.from_numpy(np.asarray(self.activations[key], dtype=np.float32)), int(self.labels[key])
+
+  def __len__(self):
+    return len(self.labels) // self.n_views
+
+
+def build_activation_cache(net, dataloader, stage, n_views, device, path=None, replay=None):
+  """
+  Runs the frozen stages of `net` once over every (sample, view) pair of the dataset of
+  `dataloader` and returns a DataLoader over the cached activations, with the batch size,
+  shuffling and drop_last of the original one. The activations are written to the .npy
+  file `path` (a temporary file when None). `replay` optionally holds (activations, labels)
+  already computed at the same stage, appended after the samples of the dataset.
+  """
+  dataset = dataloader.dataset
+  if not isinstance(dataset, ViewDataset):
+    dataset = ViewDataset(dataset, n_views)
+  n_views = dataset.n_views
+  n_replay = len(replay[1]) if replay is not None else 0
+  size = (len(dataset) + n_replay) * n_views
+
+  temporary = path is None
+  if temporary:
+    fd, path = tempfile.mkstemp(suffix='.npy')
+    os.close(fd)
+  activations, labels = None, np.zeros(size, dtype=np.int64)
+
+  was_training = net.training
+  net.train(False)
+  loader = DataLoader(dataset, batch_size=dataloader.batch_size, shuffle=False, num_workers=dataloader.num_workers, collate_fn=dataloader.collate_fn)
+  with torch.no_grad():
+    for view in range(n_views):
+      dataset.set_epoch(view)
+      for keys, images, targets in loader:
+        out = net.stem(images.to(device), stage)
+        if activations is None:
+          activations = np.lib.format.open_memmap(path, mode='w+', dtype=np.float16, shape=(size,) + tuple(out.shape[1:]))
+        keys = keys.numpy()
+        activations[keys] = out.cpu().numpy().astype(np.float16)
+        labels[keys] = targets.numpy()
+  net.train(was_training)
+
+  if n_replay > 0:
+    # replayed activations are the same in every view
+    keys = ((len(dataset) + np.arange(n_replay))[:, None] * n_views + np.arange(n_views)).reshape(-1)
+    activations[keys] = np.repeat(replay[0].cpu().numpy().astype(np.float16), n_views, axis=0)
+    labels[keys] = np.repeat(replay[1].cpu().numpy(), n_views)
+  activations.flush()
+
+  activations = np.load(path, mmap_mode='r')
+  if temporary:
+    # the mapping keeps the data readable, the file is released with the loader
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+
+  # memory-mapped arrays do not survive pickling into worker processes, batches are read in the main process
+  return DataLoader(ActivationDataset(activations, labels, n_views),
+                    batch_size=dataloader.batch_size,
+                    shuffle=isinstance(dataloader.sampler, RandomSampler),
+                    num_workers=0,
+                    collate_fn=dataloader.collate_fn,
+                    drop_last=dataloader.drop_last)
@@ -0,0 +1,112 @@
+import math
+import torch
+
+# Inverted-file (IVF) index for approximate nearest neighbour search on CPU or GPU tensors.
+# Vectors are assigned to the nearest of n_lists k-means centroids; a query only scans the
+# n_probe lists whose centroids are closest to it, so the cost of a query grows with
+# N * n_probe / n_lists instead of N. Vectors can be inserted and removed incrementally; the
+# centroids are re-trained when the index has grown enough for the lists to become unbalanced.
+# Up to `exact_size` vectors (the rehearsal memories of CIFAR-100 hold 2000 exemplars) every
+# query scans the whole index: one distance matrix is cheaper than the lists, and exact.
+
+class IVFIndex:
+
+  def __init__(self, dim, n_lists=None, n_probe=4, kmeans_iters=10, device='cpu', exact_size=4096):
+    self.dim = dim
+    self.n_lists = n_lists
+    self.n_probe = n_probe
+    self.exact_size = exact_size
+    self.kmeans_iters = kmeans_iters
+    self.device = device
+    self.reset()
+
+  def reset(self):
+    self.centroids = None
+    self.vectors = torch.zeros((0, self.dim), device=self.device)
+    self.labels = torch.zeros((0,), dtype=torch.long, device=self.device)
+    self.assignments = torch.zeros((0,), dtype=torch.long, device=self.device)
+    self.trained_size = 0
+    self.order = None
+
+  def __len__(self):
+    return self.vectors.size(0)
+
+  def kmeans(self, x, k):
+    generator = torch.Generator().manual_seed(0)
+    centroids = x[torch.randperm(x.size(0), generator=generator)[:k].to(x.device)].clone()
+    for _ in range(self.kmeans_iters):
+      assignments = torch.cdist(x, centroids).argmin(dim=1)
+      sums = torch.zeros_like(centroids).index_add_(0, assignments, x)
+      counts = torch.bincount(assignments, minlength=k).unsqueeze(1)
+      # empty clusters keep their previous centroid
+      centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+    return centroids
+
+  def train(self):
+    n = len(self)
+    k = self.n_lists if self.n_lists is not None else int(math.sqrt(n))
+    k = max(1, min(k, n))
+    self.centroids = self.kmeans(self.vectors, k)
+    self.assignments = torch.cdist(self.vectors, self.centroids).argmin(dim=1)
+    self.trained_size = n
+    self.order = None
+
+  def add(self, vectors, labels):
+    vectors = vectors.to(self.device, torch.float32)
+    labels = labels.to(self.device)
+    self.vectors = torch.cat((self.vectors, vectors), dim=0)
+    self.labels = torch.cat((self.labels, labels), dim=0)
+    if self.centroids is None or len(self) > 2 * self.trained_size:
+      self.train()
+    else:
+      self.assignments = torch.cat((self.assignments, torch.cdist(vectors, self.centroids).argmin(dim=1)), dim=0)
+      self.order = None
+
+  def remove(self, labels):
+    # drops the vectors of the given labels; the centroids are kept, and re-trained once the
+    # index has grown to twice what is left of the vectors they were trained on
+    keep = ~torch.isin(self.labels, torch.as_tensor(labels, dtype=torch.long, device=self.device))
+    self.vectors = self.vectors[keep]
+    self.labels = self.labels[keep]
+    self.assignments = self.assignments[keep]
+    self.trained_size = min(self.trained_size, len(self))
+    self.order = None
+
+  def build_lists(self):
+    # members of every list are stored contiguously in self.order, starting at self.offsets[l]
+    self.order = torch.argsort(self.assignments)
+    counts = torch.bincount(self.assignments, minlength=self.centroids.size(0))
+    self.offsets = torch.cat((torch.zeros(1, dtype=torch.long, device=self.device), counts.cumsum(0))).tolist()
+
+  def search(self, queries, k):
+    # returns distances and labels of the (approximate) k nearest neighbours of every query
+    queries = queries.to(self.device, torch.float32)
+    n_queries = queries.size(0)
+    best_dist = torch.full((n_queries, k), float('inf'), device=self.device)
+    best_labels = torch.full((n_queries, k), -1, dtype=torch.long, device=self.device)
+    if len(self) == 0:
+      return best_dist, best_labels
+    if len(self) <= self.exact_size:
+      top = torch.cdist(queries, self.vectors).topk(min(k, len(self)), dim=1, largest=False)
+      best_dist[:, :top.indices.size(1)] = top.values
+      best_labels[:, :top.indices.size(1)] = self.labels[top.indices]
+      return best_dist, best_labels
+
+    if self.order is None:
+      self.build_lists()
+    n_probe = min(self.n_probe, self.centroids.size(0))
+    probes = torch.cdist(queries, self.centroids).topk(n_probe, dim=1, largest=False).indices
+
+    for l in torch.unique(probes).tolist():
+      query_idx = (probes == l).any(dim=1).nonzero(as_tuple=True)[0]
+      members = self.order[self.offsets[l]:self.offsets[l+1]]
+      if members.numel() == 0:
+        continue
+      dist = torch.cdist(queries[query_idx], self.vectors[members])
+      # merge the candidates of this list with the best ones found so far
+      dist = torch.cat((best_dist[query_idx], dist), dim=1)
+      labels = torch.cat((best_labels[query_idx], self.labels[members].expand(query_idx.size(0), -1)), dim=1)
+      top = dist.topk(k, dim=1, largest=False)
+      best_dist[query_idx] = top.values
+      best_labels[query_idx] = labels.gather(1, top.indices)
+    return best_dist, best_labels
@@ -0,0 +1,55 @@
+import torch
+from copy import deepcopy
+
+# Snapshot of the best network of a group, kept in flat preallocated storage.
+# The parameters and buffers of the network are grouped by dtype and device, and every
+# update copies them into one flat tensor per group with a single torch.cat(out=...), so
+# no module graph is rebuilt and no tensor is allocated while the group trains. A module
+# is only materialized when the best network is asked for, and is reused (copied into in
+# place) as long as the network keeps the same structure.
+
+class BestModelTracker:
+
+  def __init__(self):
+    self.signature = None
+    self.module = None
+
+  @staticmethod
+  def structure(net):
+    return [(name, tuple(t.shape), t.dtype, t.device) for name, t in net.state_dict().items()]
+
+  def allocate(self, net):
+    self.signature = self.structure(net)
+    self.groups = {}
+    for name, shape, dtype, device in self.signature:
+      self.groups.setdefault((dtype, device), []).append((name, shape))
+    self.storage = {}
+    self.views = {}
+    for key, members in self.groups.items():
+      dtype, device = key
+      numels = [torch.Size(shape).numel() for _, shape in members]
+      self.storage[key] = torch.empty(sum(numels), dtype=dtype, device=device)
+      # views of the flat storage with the shape of every tensor of the group
+      for (name, shape), chunk in zip(members, self.storage[key].split(numels)):
+        self.views[name] = chunk.view(shape)
+    self.module = None
+
+  def update(self, net):
+    # copy the current parameters and buffers of `net` into the snapshot
+    if self.structure(net) != self.signature:
+      self.allocate(net)
+    state = net.state_dict()
+    with torch.no_grad():
+      for key, members in self.groups.items():
+        torch.cat([state[name].reshape(-1) for name, _ in members], out=self.storage[key])
+
+  def materialize(self, net):
+    # module holding the snapshot, built from `net` the first time and then updated in place
+    if self.module is None:
+      self.module = deepcopy(net)
+      for p in self.module.parameters():
+        p.grad = None
+    with torch.no_grad():
+      for name, t in self.module.state_dict().items():
+        t.copy_(self.views[name])
+    return self.module
@@ -0,0 +1,113 @@
+import os
+import json
+import random
+import hashlib
+import tempfile
+import numpy as np
+import torch
+from torch.utils.data import Subset, ConcatDataset
+
+# Content-addressed cache of the models trained on the first group of classes.
+# The first group is trained without teacher and exemplars, so every method sharing
+# the same objective, hyperparameters, seed, class split and network definition
+# produces the same model: the entry is addressed by a hash of all of them.
+
+def dataset_indices(dataset):
+  # indices of the underlying samples, following Subset/ConcatDataset wrappers
+  if isinstance(dataset, Subset):
+    inner = dataset_indices(dataset.dataset)
+    return [inner[i] for i in dataset.indices]
+  if isinstance(dataset, ConcatDataset):
+    return [i for d in dataset.datasets for i in dataset_indices(d)]
+  if hasattr(dataset, 'index_map'):
+    return [int(dataset.index_map[i]) for i in range(len(dataset))]
+  return list(range(len(dataset)))
+
+
+def network_definition(net):
+  return {
+    'class': f"{type(net).__module__}.{type(net).__qualname__}",
+    'parameters': [[name, list(p.shape)] for name, p in net.state_dict().items()]
+  }
+
+
+def config_hash(config):
+  encoded = json.dumps(config, sort_keys=True, default=str).encode()
+  return hashlib.sha256(encoded).hexdigest()
+
+
+def atomic_save(obj, path):
+  # write to a temporary file first so an interrupted save never leaves a truncated file; the file
+  # is unique to this save, so processes saving the same path concurrently never share it
+  fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path) or '.')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      torch.save(obj, f)
+      # on disk before the rename, so a crash leaves either the previous or the new file
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+  except BaseException:
+    os.remove(tmp_path)
+    raise
+
+
+class FirstTaskCache:
+
+  def __init__(self, directory):
+    self.directory = directory
+    os.makedirs(directory, exist_ok=True)
+
+  def path(self, key):
+    return os.path.join(self.directory, f"first_task_{key}.pth")
+
+  def load(self, key, device):
+    if not os.path.isfile(self.path(key)):
+      return None
+    return torch.load(self.path(key), map_location=device)
+
+  def save(self, key, config, net, best_net, stats):
+    atomic_save({
+      'config': config,
+      'net': net.state_dict(),
+      'best_net': best_net.state_dict(),
+      'stats': stats
+    }, self.path(key))
+
+
+# Checkpoint of an incremental run, written after every completed group. The trainers fill it
+# with everything the next groups depend on (networks, optimizer and scheduler, exemplars, class
+# means, RNG states and the logs so far, see Trainer.checkpoint_state). Networks, optimizer and
+# scheduler are stored as objects: the heads and teachers change shape from group to group, and
+# the optimizer keeps referring to the parameters of the loaded networks.
+
+def rng_state():
+  state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+  if torch.cuda.is_available():
+    state['cuda'] = torch.cuda.get_rng_state_all()
+  return state
+
+
+def set_rng_state(state):
+  random.setstate(state['python'])
+  np.random.set_state(state['numpy'])
+  torch.set_rng_state(state['torch'])
+  if 'cuda' in state and torch.cuda.is_available():
+    torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class RunCheckpoint:
+
+  def __init__(self, path):
+    self.path = path
+    directory = os.path.dirname(path)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+
+  def load(self, device):
+    if not os.path.isfile(self.path):
+      return None
+    return torch.load(self.path, map_location=device, weights_only=False)
+
+  def save(self, state):
+    atomic_save(state, self.path)
@@ -0,0 +1,71 @@
+import weakref
+import torch
+
+# Cache of the class means used by the nearest-mean-of-exemplars classifier.
+# Every entry remembers which network produced its features and which exemplars
+# (and, for the classes of the current split, which training subset) were summed
+# into it, so only stale classes are recomputed. Running sums are kept so that
+# trimming an exemplar set only subtracts the features of the removed exemplars.
+
+class ClassMeanCache:
+
+  def __init__(self):
+    self.entries = {}
+
+  @staticmethod
+  def network_version(net):
+    # parameters are updated in place by the optimizer, which bumps their version counter
+    return sum(p._version for p in net.parameters())
+
+  def _same_network(self, entry, net):
+    return entry['net']() is net and entry['version'] == self.network_version(net)
+
+  def is_fresh(self, c, net, exemplars, train_tag=None):
+    entry = self.entries.get(c)
+    if entry is None or not self._same_network(entry, net):
+      return False
+    return entry['keys'] == [id(e) for e in exemplars] and entry['train_tag'] == train_tag
+
+  def cached_features(self, c, net):
+    # per-exemplar features that are still valid for `net`, keyed by exemplar id
+    entry = self.entries.get(c)
+    if entry is None or entry['features'] is None or not self._same_network(entry, net):
+      return {}
+    return dict(zip(entry['keys'], entry['features']))
+
+  def update(self, c, net, exemplars, features, train_tag=None, train_sum=None, train_count=0):
+    features = torch.stack(features) if len(features) > 0 else None
+    self.entries[c] = {
+      'net': weakref.ref(net),
+      'version': self.network_version(net),
+      'keys': [id(e) for e in exemplars],
+      'features': features,
+      'sum': features.sum(dim=0) if features is not None else 0,
+      'train_tag': train_tag,
+      'train_sum': train_sum,
+      'train_count': train_count
+    }
+
+  def trim(self, c, m):
+    # keep the first m exemplars of class c, removing the others from the running sum
+    entry = self.entries.get(c)
+    if entry is None or entry['features'] is None or len(entry['keys']) <= m:
+      return
+    entry['sum'] = entry['sum'] - entry['features'][m:].sum(dim=0)
+    entry['features'] = entry['features'][:m]
+    entry['keys'] = entry['keys'][:m]
+
+  def mean(self, c):
+    entry = self.entries[c]
+    total = entry['sum']
+    count = len(entry['keys'])
+    if entry['train_sum'] is not None:
+      total = total + entry['train_sum']
+      count += entry['train_count']
+    if count == 0:
+      raise ValueError(f"class {c} has no exemplars and no training samples, its mean is undefined")
+    class_mean = total / count
+    return class_mean / class_mean.norm()
+
+  def clear(self):
+    self.entries = {}
@@ -0,0 +1,64 @@
+import os
+import warnings
+import torch
+import torch.nn as nn
+
+# Compiled execution of ResNet-32. The network is compiled stage by stage: layer1, layer2 and
+# layer3 (with conv1 and bn1 run eagerly ahead of them, see ResNet.features, so `input_stage` stays
+# a Python switch) and the head on its own. add_output_nodes replaces only the head, so only the
+# head is compiled again, and it is compiled with dynamic shapes so its graph serves every number
+# of outputs. Modules are compiled in place (nn.Module.compile), which keeps their parameters and
+# state_dict keys; deep copies come back uncompiled and are compiled again by the trainer, reusing
+# the graphs already built for the original. The compiled graphs are kept in an on-disk cache
+# (`cache_dir`), so later groups and later runs on the machine skip the compilation.
+# Where torch.compile is unavailable, the modules are scripted with TorchScript instead.
+
+COMPILED_STAGES = ('layer1', 'layer2', 'layer3')
+# modules compiled in place share the graph cache of nn.Module._call_impl: one graph per stage,
+# train/eval mode, grad mode and frozen parameters, above the default limit of 8
+RECOMPILE_LIMIT = 64
+
+
+def compile_available():
+  return hasattr(nn.Module, 'compile')
+
+
+def enable_compile_cache(cache_dir):
+  os.makedirs(cache_dir, exist_ok=True)
+  os.environ['TORCHINDUCTOR_CACHE_DIR'] = cache_dir
+  import torch._inductor.config as inductor_config
+  inductor_config.fx_graph_cache = True
+
+
+def is_compiled(module):
+  return isinstance(module, torch.jit.ScriptModule) or getattr(module, '_compiled_call_impl', None) is not None
+
+
+def compile_module(parent, name, backend='inductor', dynamic=None):
+  module = getattr(parent, name)
+  if is_compiled(module):
+    return
+  if compile_available():
+    module.compile(backend=backend, dynamic=dynamic)
+    return
+  try:
+    # scripted modules share the parameters of the original one
+    setattr(parent, name, torch.jit.script(module))
+  except Exception as e:
+    warnings.warn(f"{name} could not be scripted, it runs eagerly: {e}", RuntimeWarning)
+
+
+def compile_network(net, backend='inductor'):
+  # compiles the stages and the head of every ResNet in `net` (teachers wrap the network they run)
+  if compile_available():
+    config = torch._dynamo.config
+    name = 'recompile_limit' if hasattr(config, 'recompile_limit') else 'cache_size_limit'
+    setattr(config, name, max(getattr(config, name), RECOMPILE_LIMIT))
+  for module in net.modules():
+    if hasattr(module, 'input_stage'):
+      for name in COMPILED_STAGES:
+        compile_module(module, name, backend)
+      # the int8 teachers run a dynamically quantized head, which is left eager
+      if isinstance(getattr(module.fc, 'weight', None), nn.Parameter):
+        compile_module(module, 'fc', backend, dynamic=True)
+  return net
@@ -0,0 +1,160 @@
+import os
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, RandomSampler, Subset
+from torch.utils.data.distributed import DistributedSampler
+
+# Data-parallel training over several processes (one or more nodes) with the gloo backend.
+# Every rank holds a full replica of the networks and trains on its shard of the group data:
+# the group loaders (including the exemplar ConcatDataset) are rebuilt on a DistributedSampler,
+# with the batch size divided among the ranks so the global batch and the learning rate schedule
+# stay those of a single process. After backward the gradients are averaged across ranks, in one
+# flat all-reduce per dtype, before the optimizer step. This is the reduction of
+# DistributedDataParallel, done on the optimizer instead of a module wrapper because the methods
+# train through net.features and net.forward_with_features as well as net.forward, which the
+# wrapper does not hook. BatchNorm statistics are broadcast from rank 0 after every epoch, as
+# DistributedDataParallel does with its buffers. Validation is sharded too, without the padding
+# of DistributedSampler (which evaluates some samples twice), and its metrics are all-reduced, so
+# every rank takes the same best-model and epoch-budget decisions as a single process.
+#
+# Launch one process per rank with torchrun (or set RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT),
+# call init_distributed() and set Trainer.DISTRIBUTED. The batch size of the training loaders
+# must be a multiple of the world size.
+#
+# `python -m model.distributed [world_size]` checks the mode on one machine: it spawns world_size
+# gloo processes (2 by default) that train a small network on synthetic data through shard_loader
+# and synchronize_optimizer and evaluate it through split_loader, and compares the weights and
+# the reduced metrics with a single-process run.
+
+
+def init_distributed(backend='gloo'):
+  if not dist.is_initialized():
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    dist.init_process_group(backend, rank=int(os.environ.get('RANK', 0)), world_size=int(os.environ.get('WORLD_SIZE', 1)))
+  return dist.get_rank(), dist.get_world_size()
+
+
+def is_main_process():
+  return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def process_rank():
+  return dist.get_rank() if dist.is_initialized() else 0
+
+
+def world_size():
+  return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def shard_loader(dataloader, seed=0):
+  # same loader over the shard of the dataset of this rank
+  world_size = dist.get_world_size()
+  assert dataloader.batch_size % world_size == 0, f"the batch size {dataloader.batch_size} must be a multiple of the world size {world_size}"
+  sampler = DistributedSampler(dataloader.dataset,
+                               shuffle=isinstance(dataloader.sampler, RandomSampler),
+                               seed=seed,
+                               drop_last=dataloader.drop_last)
+  return DataLoader(dataloader.dataset,
+                    batch_size=dataloader.batch_size // world_size,
+                    sampler=sampler,
+                    num_workers=dataloader.num_workers,
+                    collate_fn=dataloader.collate_fn,
+                    drop_last=dataloader.drop_last)
+
+
+def split_loader(dataloader):
+  # loader over the samples rank::world_size of the dataset: the shards partition it exactly, every sample
+  # is evaluated once (no padding, no dropped batch)
+  rank, world_size = dist.get_rank(), dist.get_world_size()
+  shard = Subset(dataloader.dataset, range(rank, len(dataloader.dataset), world_size))
+  return DataLoader(shard,
+                    batch_size=max(1, dataloader.batch_size // world_size),
+                    shuffle=False,
+                    num_workers=dataloader.num_workers,
+                    collate_fn=dataloader.collate_fn)
+
+
+def broadcast_object(obj, src=0):
+  objects = [obj]
+  dist.broadcast_object_list(objects, src=src)
+  return objects[0]
+
+
+def broadcast_module(net, src=0, buffers_only=False):
+  # parameters and buffers of rank src on every rank (new heads are initialised differently on every rank)
+  with torch.no_grad():
+    tensors = list(net.buffers()) if buffers_only else list(net.parameters()) + list(net.buffers())
+    for t in tensors:
+      dist.broadcast(t.data, src=src)
+
+
+def average_gradients(parameters):
+  grads = [p.grad for p in parameters if p.grad is not None]
+  world_size = dist.get_world_size()
+  groups = {}
+  for g in grads:
+    groups.setdefault((g.dtype, g.device), []).append(g)
+  for members in groups.values():
+    flat = torch.cat([g.reshape(-1) for g in members])
+    dist.all_reduce(flat)
+    flat /= world_size
+    for g, chunk in zip(members, flat.split([g.numel() for g in members])):
+      g.copy_(chunk.view_as(g))
+
+
+def synchronize_optimizer(optimizer):
+  # averages the gradients of every parameter of the optimizer before each of its steps
+  if getattr(optimizer, '_gradients_synchronized', False):
+    return
+  optimizer.register_step_pre_hook(lambda opt, args, kwargs: average_gradients(p for group in opt.param_groups for p in group['params']))
+  optimizer._gradients_synchronized = True
+
+
+def _check_process(rank, world_size, port):
+  # one rank of the check: the same epoch trained on one process and across the ranks
+  import torch.nn as nn
+  from copy import deepcopy
+  from torch.utils.data import TensorDataset
+  from model.metrics import RunningMetrics
+  os.environ.update(RANK=str(rank), WORLD_SIZE=str(world_size), MASTER_PORT=str(port))
+  init_distributed()
+  generator = torch.Generator().manual_seed(0)
+  images, labels = torch.randn(96, 16, generator=generator), torch.randint(0, 4, (96,), generator=generator)
+  dataloader = DataLoader(TensorDataset(torch.arange(96), images, labels), batch_size=8 * world_size)
+
+  def train(net, loader):
+    optimizer = torch.optim.SGD(net.parameters(), lr=0.1, momentum=0.9)
+    if dist.is_initialized() and loader is not dataloader:
+      synchronize_optimizer(optimizer)
+    for _, x, y in loader:
+      optimizer.zero_grad()
+      nn.functional.cross_entropy(net(x), y).backward()
+      optimizer.step()
+    return net
+
+  torch.manual_seed(0)
+  single = nn.Sequential(nn.Linear(16, 32), nn.ReLU(), nn.Linear(32, 4))
+  sharded = train(deepcopy(single), shard_loader(dataloader))
+  single = train(single, dataloader)
+  error = max((a - b).abs().max().item() for a, b in zip(single.parameters(), sharded.parameters()))
+
+  # validation over 97 samples, not a multiple of the world size
+  evaluation = DataLoader(TensorDataset(torch.arange(97), torch.randn(97, 16, generator=generator), torch.randint(0, 4, (97,), generator=generator)), batch_size=10)
+  metrics = RunningMetrics('cpu')
+  with torch.no_grad():
+    for _, x, y in split_loader(evaluation):
+      metrics.update(single(x).argmax(dim=1), y)
+  metrics.all_reduce(len(split_loader(evaluation)))
+  corrects = sum((single(x).argmax(dim=1) == y).sum().item() for _, x, y in evaluation)
+  if rank == 0:
+    print(f"{world_size} ranks: max weight difference {error:.2e}, validation {metrics.corrects.item()}/{metrics.total} (single process {corrects}/97)")
+  assert error < 1e-5 and metrics.total == 97 and metrics.corrects.item() == corrects, "data-parallel run differs from the single-process one"
+  dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+  import sys
+  import torch.multiprocessing as mp
+  world_size = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+  mp.spawn(_check_process, args=(world_size, 29511), nprocs=world_size)
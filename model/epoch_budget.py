@@ -0,0 +1,61 @@
+import time
+
+# Epoch budget of a group. The validation accuracy of the later groups, with few new classes,
+# often plateaus long before the last epoch. After `patience` epochs without an improvement of
+# more than `min_delta`, the next milestone of the MultiStepLR scheduler is brought forward to
+# the current epoch (and the later milestones by the same number of epochs); once no milestone
+# is left, a further plateau ends the group. `time_budget` (seconds) ends the group when the
+# next epoch, at the mean duration of the previous ones, would exceed it.
+
+class EpochBudget:
+
+  def __init__(self, num_epochs, scheduler, patience=None, min_delta=0.0, time_budget=None):
+    self.num_epochs = num_epochs
+    self.scheduler = scheduler
+    self.patience = patience
+    self.min_delta = min_delta
+    self.time_budget = time_budget
+    self.best_acc = None
+    self.stale_epochs = 0
+    self.epochs = 0
+    self.reason = None
+    self.start = time.perf_counter()
+
+  def future_milestones(self):
+    milestones = getattr(self.scheduler, 'milestones', {})
+    return sorted(m for m in milestones if m > self.scheduler.last_epoch)
+
+  def advance_milestones(self):
+    # called before scheduler.step(), which then applies the first of the future milestones
+    future = self.future_milestones()
+    shift = future[0] - (self.scheduler.last_epoch + 1)
+    milestones = self.scheduler.milestones
+    for m in future:
+      count = milestones.pop(m)
+      milestones[m - shift] += count
+    print(f"Validation plateau: milestones moved {shift} epochs earlier to {sorted(m for m in milestones if m > self.scheduler.last_epoch)}")
+
+  def update(self, validate_acc):
+    # called once per epoch, after validation and before scheduler.step(); returns True when the group has to stop
+    self.epochs += 1
+    if self.best_acc is None or validate_acc > self.best_acc + self.min_delta:
+      self.best_acc = validate_acc
+      self.stale_epochs = 0
+    else:
+      self.stale_epochs += 1
+
+    if self.patience is not None and self.stale_epochs >= self.patience:
+      if self.future_milestones():
+        self.advance_milestones()
+        self.stale_epochs = 0
+      else:
+        self.reason = 'plateau'
+
+    elapsed = time.perf_counter() - self.start
+    if self.time_budget is not None and elapsed + elapsed / self.epochs > self.time_budget:
+      self.reason = 'time budget'
+    return self.reason is not None and self.epochs < self.num_epochs
+
+  @property
+  def saved_epochs(self):
+    return self.num_epochs - self.epochs
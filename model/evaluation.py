@@ -0,0 +1,50 @@
+from torch.utils.data import DataLoader, RandomSampler
+from model.teacher import freeze_teacher
+
+# Shared settings of the evaluation passes (validation, test, open-set and rejection tests).
+# The passes run under torch.inference_mode, so no autograd state is kept for the forward;
+# `batch_size` and `num_workers` rebuild the evaluation DataLoaders (None keeps theirs) and
+# `freeze` evaluates a BatchNorm-folded inference copy of the network (see model.teacher),
+# rebuilt only when the weights of the network have changed. Only the passes over a fixed
+# network (the tests of the best network) are frozen: the network validated after every epoch
+# changes between passes, and folding it each time would cost more than it saves.
+
+class EvaluationEngine:
+
+  def __init__(self, batch_size=None, freeze=False, num_workers=None):
+    self.batch_size = batch_size
+    self.freeze = freeze
+    self.num_workers = num_workers
+    self.loaders = {}
+    self.frozen = None
+
+  def loader(self, dataloader):
+    batch_size = self.batch_size if self.batch_size is not None else dataloader.batch_size
+    num_workers = self.num_workers if self.num_workers is not None else dataloader.num_workers
+    if batch_size == dataloader.batch_size and num_workers == dataloader.num_workers:
+      return dataloader
+    entry = self.loaders.get(id(dataloader))
+    if entry is None or entry[0] is not dataloader or (entry[1].batch_size, entry[1].num_workers) != (batch_size, num_workers):
+      entry = (dataloader, DataLoader(dataloader.dataset,
+                                      batch_size=batch_size,
+                                      shuffle=isinstance(dataloader.sampler, RandomSampler),
+                                      num_workers=num_workers,
+                                      collate_fn=dataloader.collate_fn,
+                                      drop_last=dataloader.drop_last))
+      self.loaders[id(dataloader)] = entry
+    return entry[1]
+
+  @staticmethod
+  def version(net):
+    # in-place updates of parameters and buffers bump their version counters
+    return sum(t._version for t in net.state_dict(keep_vars=True).values())
+
+  def model(self, net, fixed=True):
+    # fixed: the network is no longer trained (False for the per-epoch validation)
+    net.train(False)
+    if not self.freeze or not fixed:
+      return net
+    key = (id(net), self.version(net), net.fc.out_features)
+    if self.frozen is None or self.frozen[0] != key:
+      self.frozen = (key, freeze_teacher(net))
+    return self.frozen[1]
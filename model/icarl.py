@@ -6,14 +6,26 @@ from torch.backends import cudnn
 from torch.utils.data import DataLoader, ConcatDataset
 import numpy as np
 from math import floor
-from copy import copy, deepcopy
+from copy import copy
 from model.lwf import LearningWithoutForgetting
+from model.metrics import RunningMetrics, ResultCollector, loader_size
+from model.teacher import TeacherCache
+from model.activations import set_input_stage
+from model.distributed import broadcast_object, is_main_process
+from model.profiling import timed
 from data.exemplar import Exemplar
+from model.class_means import ClassMeanCache
+from model.ann import IVFIndex
 import random
 
 from sklearn.svm import SVC
 from sklearn.metrics import accuracy_score
+from sklearn.metrics.pairwise import pairwise_kernels
 from sklearn.model_selection  import ParameterGrid
+from joblib import Parallel, delayed
+
+# bytes of a CIFAR image exemplar (32x32 RGB, uint8), the unit of the rehearsal memory budget
+IMAGE_BYTES = 32 * 32 * 3
 
 class iCaRL(LearningWithoutForgetting):
   
@@ -29,8 +41,12 @@ class iCaRL(LearningWithoutForgetting):
     self.memory_size = 2000
     self.exemplar_set = []
     self.means = None
+    self.means_cache = ClassMeanCache()
+    # with the frozen-backbone mode, keep the exemplars of the frozen groups as fp16 activations at
+    # FROZEN_STAGE (latent replay) instead of images, within the same memory budget in bytes
+    self.LATENT_REPLAY = False
   
-  def train_model(self, num_epochs, herding: bool, classify: bool):
+  def train_model(self, num_epochs, herding: bool, classify: bool, resume=None):
     
     cudnn.benchmark
     
@@ -40,9 +56,14 @@ class iCaRL(LearningWithoutForgetting):
              'test_accuracies': [float for j in range(10)],
              'true_labels': [int],
              'val_accuracies': [float for j in range(10)],
-             'val_losses': [float for j in range(10)]}
+             'val_losses': [float for j in range(10)],
+             'epochs_saved': [int for j in range(10)],
+             'profile': [dict for j in range(10)]}
+    config = self.run_config(num_epochs, herding=herding, classify=classify)
+    start, logs = self.resume_run(resume, logs, config)
     
-    for g in range(10):
+    for g in range(start, 10):
+      self.timers.reset()
       self.net.to(self.DEVICE)
       if self.old_net is not None: self.old_net = self.old_net.to(self.DEVICE)
       
@@ -50,32 +71,10 @@ class iCaRL(LearningWithoutForgetting):
       self.optimizer = optim.SGD(self.parameters_to_optimize, lr=self.START_LR, momentum=self.MOMENTUM, weight_decay=self.WEIGHT_DECAY)
       self.scheduler = optim.lr_scheduler.MultiStepLR(self.optimizer, milestones=self.MILESTONES, gamma=self.GAMMA)
       
-      best_acc = 0
-      self.best_net = deepcopy(self.net)
-      
       # augment train_set with exemplars and define DataLoaders for the current group
       self.update_representation(g)
 
-      for epoch in range(num_epochs):
-        e_loss, e_acc = self.train_epoch(g)
-        e_print = epoch + 1
-        print(f"Epoch {e_print}/{num_epochs} LR: {self.scheduler.get_last_lr()}")
-        
-        validate_loss, validate_acc = self.validate(g)
-        g_print = g + 1
-        print(f"Validation accuracy on group {g_print}/10: {validate_acc:.2f}")
-        self.scheduler.step()
-        
-        if self.VALIDATE and validate_acc > best_acc:
-          best_acc = validate_acc
-          self.best_net = deepcopy(self.net)
-          best_epoch = epoch
-          print("Best model updated")
-        print("")
-        
-      print(f"Group {g_print} Finished!")
-      be_print = best_epoch + 1
-      print(f"Best accuracy found at epoch {be_print}: {best_acc:.2f}")
+      e_loss, e_acc, validate_loss, validate_acc = self.train_group(g, num_epochs, 10)
       
       m = self.reduce_exemplar_set()
       self.construct_exemplar_set(self.train_set[g], m, herding)
@@ -92,90 +91,117 @@ class iCaRL(LearningWithoutForgetting):
       logs['group_train_accuracies'][g] = e_acc
       logs['val_losses'][g] = validate_loss
       logs['val_accuracies'][g] = validate_acc
+      logs['epochs_saved'][g] = self.epochs_saved[g]
       logs['test_accuracies'][g] = test_accuracy
 
       if g < 9:
         self.add_output_nodes()
-        self.old_net = deepcopy(self.best_net)
+        self.old_net = self.make_teacher(self.best_net, g)
+      logs['profile'][g] = self.group_profile(g)
+
+      logs['true_labels'] = true_targets
+      logs['predictions'] = predictions
+      self.save_run(resume, g, logs, config)
 
-    logs['true_labels'] = true_targets
-    logs['predictions'] = predictions
     return logs
 
+  def checkpoint_state(self, classes_group_idx, logs):
+    state = super().checkpoint_state(classes_group_idx, logs)
+    state['exemplar_set'] = self.exemplar_set
+    state['means'] = self.means
+    return state
+
+  def load_checkpoint_state(self, state):
+    super().load_checkpoint_state(state)
+    self.exemplar_set = state['exemplar_set']
+    self.means = state['means']
+    # the cached means refer to the networks of the interrupted process, they are recomputed when needed
+    self.means_cache = ClassMeanCache()
+
 ########################################################################################################################
   
+  @timed('test')
   def test_classify(self, classes_group_idx, train_set):
     self.best_net.train(False)
     if self.best_net is not None: self.best_net.train(False)
     if self.old_net is not None: self.old_net.train(False)
-    running_corrects = 0
-    total = 0
-
-    all_preds = torch.tensor([])
-    all_preds = all_preds.type(torch.LongTensor)
-    all_targets = torch.tensor([])
-    all_targets = all_targets.type(torch.LongTensor)
+    dataloader = self.evaluation.loader(self.test_dl[classes_group_idx])
+    metrics = RunningMetrics(self.DEVICE)
+    results = ResultCollector(loader_size(dataloader), self.DEVICE, targets=torch.long, preds=torch.long)
     
-    self.means = None
     if train_set is not None: train_set.dataset.set_transform_status(False)
+    with torch.inference_mode():
+      # only the class means that are stale for the current network are recomputed
+      self.mean_of_exemplars(train_set)
     
-    for _, images, labels in self.test_dl[classes_group_idx]:
-      images = images.to(self.DEVICE)
-      labels = labels.to(self.DEVICE)
-      total += labels.size(0)
+      for _, images, labels in self.timers.iterate(dataloader, 'test'):
+        images = images.to(self.DEVICE)
+        labels = labels.to(self.DEVICE)
 
-      with torch.no_grad():
         preds = self.classify(images, train_set)
-      
-      running_corrects += torch.sum(preds == labels.data).data.item()
+        
+        metrics.update(preds, labels.data)
 
-      all_targets = torch.cat((all_targets.to(self.DEVICE), labels.to(self.DEVICE)), dim=0)
-      all_preds = torch.cat((all_preds.to(self.DEVICE), preds.to(self.DEVICE)), dim=0)
+        results.add('targets', labels)
+        results.add('preds', preds)
 
-    else:
-      if train_set is not None: train_set.dataset.set_transform_status(True)
-      accuracy = running_corrects / float(total)  
+    if train_set is not None: train_set.dataset.set_transform_status(True)
+    accuracy = metrics.accuracy()
 
-    return accuracy, all_targets, all_preds
+    return accuracy, results.result('targets'), results.result('preds')
   
   def update_representation(self, classes_group_idx):
     print(f"Length of exemplars set: {sum([len(self.exemplar_set[i]) for i in range(len(self.exemplar_set))])}")
-    exemplars = Exemplar(self.exemplar_set, self.train_transform)
+    # latent exemplars are appended to the cached activations of the group instead (see replay_activations)
+    exemplars = Exemplar([] if self.latent_replay(classes_group_idx-1) else self.exemplar_set, self.train_transform)
     ex_train_set = ConcatDataset([exemplars, self.train_set[classes_group_idx]])
     
     tmp_dl = DataLoader(ex_train_set,
                         batch_size=self.BATCH_SIZE,
                         shuffle=True, 
-                        num_workers=4,
+                        num_workers=self.NUM_WORKERS,
                         drop_last=True)
     self.train_dl[classes_group_idx] = copy(tmp_dl)
+    self.prepare_teacher_cache(classes_group_idx)
     
+  @timed('exemplars')
   def reduce_exemplar_set(self):
     m = floor(self.memory_size / self.net.fc.out_features)      
+    if self.latent_replay(len(self.exemplar_set) // 10):
+      m = floor(self.memory_size * IMAGE_BYTES / (self.net.fc.out_features * self.latent_bytes()))
     print(f"Target number of exemplars: {m}")
 
     # from the current exemplar set, keep only first m
     for i in range(len(self.exemplar_set)):
       current_exemplar_set = self.exemplar_set[i]
       self.exemplar_set[i] = current_exemplar_set[:m]
+      self.means_cache.trim(i, m)
     
     return m
   
+  @timed('exemplars')
   def construct_exemplar_set(self, train_set, m, herding: bool):   
-    train_set.dataset.set_transform_status(False)    
-    samples = [[] for i in range(10)]
     new_exemplar_set = [[] for i in range(10)]
-    for _, images, labels in train_set:
-      labels = labels % 10
-      samples[labels].append(images)
-    train_set.dataset.set_transform_status(True)
-    
-    if herding is True:
-      new_exemplar_set = self.prioritized_selection(samples, new_exemplar_set, m)
-    else:
-      new_exemplar_set = self.random_selection(samples, new_exemplar_set, m)
+    # in a distributed run the exemplars are selected on rank 0 and broadcast, every rank replays the same ones
+    if not self.DISTRIBUTED or is_main_process():
+      train_set.dataset.set_transform_status(False)    
+      samples = [[] for i in range(10)]
+      for _, images, labels in train_set:
+        labels = labels % 10
+        samples[labels].append(images)
+      train_set.dataset.set_transform_status(True)
+      
+      if herding is True:
+        new_exemplar_set = self.prioritized_selection(samples, new_exemplar_set, m)
+      else:
+        new_exemplar_set = self.random_selection(samples, new_exemplar_set, m)
+    if self.DISTRIBUTED:
+      new_exemplar_set = broadcast_object(new_exemplar_set)
     
+    g = len(self.exemplar_set) // 10
     self.exemplar_set.extend(new_exemplar_set)
+    if self.latent_replay(g):
+      self.encode_exemplars()
       
   def prioritized_selection(self, samples, exemplars, m):
     for i in range(10):
@@ -205,6 +231,49 @@ class iCaRL(LearningWithoutForgetting):
       print(f"Extracted {len(exemplars[i])} exemplars.")
     return exemplars
 
+########## LATENT REPLAY ################################################################
+
+  def latent_replay(self, classes_group_idx):
+    # the stages below the cut are frozen from the end of group FREEZE_AFTER_GROUP on, so the
+    # activations of the exemplars selected from then on stay valid for the rest of the training
+    return self.LATENT_REPLAY and self.FREEZE_AFTER_GROUP is not None and classes_group_idx >= self.FREEZE_AFTER_GROUP
+
+  def latent_bytes(self):
+    # size of a fp16 exemplar activation at the cut point
+    with torch.no_grad():
+      self.best_net.train(False)
+      latent = self.best_net.stem(torch.zeros(1, 3, 32, 32, device=self.DEVICE), self.FROZEN_STAGE)
+    return latent[0].numel() * 2
+
+  def encode_exemplars(self):
+    # replace the image exemplars with their activations through the stages that get frozen,
+    # taken from best_net like the frozen stages themselves (see Trainer.freeze_backbone)
+    self.best_net.train(False)
+    with torch.no_grad():
+      for i in range(len(self.exemplar_set)):
+        images = self.exemplar_set[i]
+        if len(images) == 0 or torch.is_tensor(images[0]):
+          continue
+        latents = []
+        for start in range(0, len(images), self.BATCH_SIZE):
+          batch = torch.stack([self.test_transform(img) for img in images[start:start+self.BATCH_SIZE]]).to(self.DEVICE, memory_format=self.memory_format)
+          latents.extend(self.best_net.stem(batch, self.FROZEN_STAGE).to('cpu', torch.float16))
+        self.exemplar_set[i] = latents
+
+  def replay_activations(self):
+    latents = [(latent, i) for i in range(len(self.exemplar_set)) for latent in self.exemplar_set[i] if torch.is_tensor(latent)]
+    if len(latents) == 0:
+      return None
+    return torch.stack([l for l, _ in latents]), torch.tensor([i for _, i in latents])
+
+  def freeze_backbone(self, classes_group_idx):
+    images_dl = super().freeze_backbone(classes_group_idx)
+    if self.teacher_cache is not None:
+      # the replayed exemplars add (sample, view) keys to the group
+      dataset = self.train_dl[classes_group_idx].dataset
+      self.teacher_cache = TeacherCache(len(dataset) * dataset.n_views, self.DEVICE)
+    return images_dl
+
 ########## ALGORITHM 1 ################################################################## 
 
   def classify(self, images, train_set=None):
@@ -232,7 +301,8 @@ class iCaRL(LearningWithoutForgetting):
     if batch is False:
       images = transform(images)
       images = images.unsqueeze(0)
-    images = images.to(self.DEVICE)
+    # batches of the formatted loaders already are in the memory format of the network
+    images = images.to(self.DEVICE, memory_format=self.memory_format)
     
     if self.VALIDATE: features = self.best_net.features(images)
     else: features = self.net.features(images)
@@ -240,36 +310,58 @@ class iCaRL(LearningWithoutForgetting):
     
     return features
   
+  @timed('class_means')
   def mean_of_exemplars(self, train_set=None):
     print("Computing mean of exemplars... ", end="")
-    self.means = []
-    if train_set is not None:
-      train_features = [[] for i in range(10)]
+    net = self.best_net if self.VALIDATE else self.net
+    num_classes = len(self.exemplar_set)
+    train_tag = id(train_set) if train_set is not None else None
+
+    stale = [i for i in range(num_classes)
+             if not self.means_cache.is_fresh(i, net, self.exemplar_set[i], train_tag if i >= num_classes-10 else None)]
+    
+    if train_set is not None and any(i >= num_classes-10 for i in stale):
+      train_images = [[] for i in range(10)]
       for _, img, labels in train_set:
-        f = self.features_extractor(img, False, self.test_transform)
-        f = f / f.norm()
-        train_features[labels % 10].append(f)
+        train_images[labels % 10].append(img)
+
+    for i in stale:
+      # exemplar features still valid for this network are reused
+      known = self.means_cache.cached_features(i, net)
+      missing = [img for img in self.exemplar_set[i] if id(img) not in known]
+      computed = dict(zip([id(img) for img in missing], self.normalized_features(missing)))
+      f_list = [known[id(img)] if id(img) in known else computed[id(img)] for img in self.exemplar_set[i]]
 
-    num_classes = len(self.exemplar_set)
-    for i in range(num_classes):
       if (train_set is not None) and (i in range(num_classes-10, num_classes)):
-        f_list = train_features[i % 10]
+        train_features = self.normalized_features(train_images[i % 10])
+        train_sum = torch.stack(train_features).sum(dim=0) if len(train_features) > 0 else None
+        self.means_cache.update(i, net, self.exemplar_set[i], f_list, train_tag, train_sum, len(train_features))
       else:
-        f_list = []
-
-      for img in self.exemplar_set[i]:
-        f = self.features_extractor(img, False, self.test_transform)
-        f = f / f.norm()
-        f_list.append(f)
+        self.means_cache.update(i, net, self.exemplar_set[i], f_list)
 
-      f_list = torch.stack(f_list)
-      class_means = f_list.mean(dim=0)
-      class_means = class_means/class_means.norm()
+    self.means = torch.stack([self.means_cache.mean(i) for i in range(num_classes)]).to(self.DEVICE)
+    print("done")
 
-      self.means.append(class_means)
+  def normalized_features(self, images):
+    # L2-normalised features of a list of PIL images (or latent exemplars), extracted in batches
+    features = []
+    with torch.no_grad():
+      for start in range(0, len(images), self.BATCH_SIZE):
+        if torch.is_tensor(images[start]):
+          f = self.latent_features(torch.stack(images[start:start+self.BATCH_SIZE]).float())
+        else:
+          batch = torch.stack([self.test_transform(img) for img in images[start:start+self.BATCH_SIZE]])
+          f = self.features_extractor(batch)
+        features.extend(f / f.norm(dim=1, keepdim=True))
+    return features
 
-    self.means = torch.stack(self.means).to(self.DEVICE)
-    print("done")
+  def latent_features(self, latents):
+    net = self.best_net if self.VALIDATE else self.net
+    set_input_stage(net, self.FROZEN_STAGE)
+    try:
+      return self.features_extractor(latents)
+    finally:
+      set_input_stage(net, None)
     
 ################################################################################################################
 
@@ -278,75 +370,260 @@ class SVM_Classifier(iCaRL):
   def __init__(self, device, net, LR, MOMENTUM, WEIGHT_DECAY, MILESTONES, GAMMA, train_dl, validation_dl, test_dl, BATCH_SIZE, train_subset, train_transform, test_transform, params):
     super().__init__(device, net, LR, MOMENTUM, WEIGHT_DECAY, MILESTONES, GAMMA, train_dl, validation_dl, test_dl, BATCH_SIZE, train_subset, train_transform, test_transform)
     self.PARAMS = params
+    self.N_JOBS = -1
 
   def separate_data(self, data):
-    all_features = torch.tensor([])
-    all_features = all_features.type(torch.LongTensor)
-    all_targets = torch.tensor([])
-    all_targets = all_targets.type(torch.LongTensor)
+    results = ResultCollector(loader_size(data), self.DEVICE, features=torch.float32, targets=torch.long)
     for _, images, labels in data:
       images = images.to(self.DEVICE)
       labels = labels.to(self.DEVICE)
       
-      all_targets = torch.cat((all_targets.to(self.DEVICE), labels.to(self.DEVICE)), dim=0)
+      results.add('targets', labels)
       feature_map = self.features_extractor(images)
       for i in range(feature_map.size(0)):
         feature_map[i] = feature_map[i] / feature_map[i].norm()
       feature_map = feature_map.to(self.DEVICE)
-      all_features = torch.cat((all_features.to(self.DEVICE), feature_map.to(self.DEVICE)), dim=0)
-    return all_features.detach().cpu(), all_targets.detach().cpu()
+      results.add('features', feature_map.detach())
+    return results.result('features').cpu(), results.result('targets').cpu()
     
     
+  @timed('classifier_fit')
   def fit_train_data(self, classes_group_idx, train_set):
     
     #exemplars = Exemplar(self.exemplar_set, self.train_transform)
     #tmp_dl = DataLoader(exemplars,
                         #batch_size=self.BATCH_SIZE)
+    assert not self.LATENT_REPLAY, "the SVM is fitted on exemplar images, latent replay keeps none"
     X_train, y_train = self.separate_data(self.train_dl[classes_group_idx])
-    X_test, y_test = self.separate_data(self.validation_dl[classes_group_idx])
+    X_test, y_test = self.separate_data(self.evaluation.loader(self.validation_dl[classes_group_idx]))
+    X_train, y_train = X_train.numpy().astype(np.float64), y_train.numpy()
+    X_test, y_test = X_test.numpy().astype(np.float64), y_test.numpy()
     
-    self.clf = SVC()   
+    # candidates that only differ in C share the same kernel matrices, which are
+    # computed once; the fits themselves run in parallel over the precomputed kernels
+    kernel_groups = {}
+    for grid in ParameterGrid(self.PARAMS):
+      kernel_args = PrecomputedSVC.kernel_args(grid, X_train)
+      key = tuple(sorted(kernel_args.items()))
+      kernel_groups.setdefault(key, (kernel_args, []))[1].append(grid)
+
     best_clf = None
     best_grid = None
     best_score = 0
     
-    for grid in ParameterGrid(self.PARAMS):
-        self.clf.set_params(**grid)
-        self.clf.fit(X_train, y_train)
-        y_pred = self.clf.predict(X_test)
-        score = accuracy_score(y_test, y_pred)
-
+    for kernel_args, grids in kernel_groups.values():
+      K_train = pairwise_kernels(X_train, X_train, **kernel_args)
+      K_test = pairwise_kernels(X_test, X_train, **kernel_args)
+      results = Parallel(n_jobs=self.N_JOBS)(
+        delayed(fit_precomputed_svc)(grid, K_train, y_train, K_test, y_test) for grid in grids)
+      
+      for grid, (score, clf) in zip(grids, results):
         if score > best_score:
-            best_clf = deepcopy(self.clf)
-            best_score = score
-            best_grid = grid
+          best_clf = PrecomputedSVC(clf, X_train, kernel_args)
+          best_score = score
+          best_grid = grid
     self.clf = best_clf
 
     print(f"Best classifier: {best_grid} with score {best_score}")
   
   def predict_test_data(self, classes_group_idx):
-    X_test, y_test = self.separate_data(self.test_dl[classes_group_idx])
+    X_test, y_test = self.separate_data(self.evaluation.loader(self.test_dl[classes_group_idx]))
     y_pred = self.clf.predict(X_test)
     return y_test, y_pred
   
+  @timed('test')
   def test_classify(self, classes_group_idx, train_set):
     self.best_net.train(False)
     if self.best_net is not None: self.best_net.train(False)
     if self.old_net is not None: self.old_net.train(False)
-
-    all_preds = torch.tensor([])
-    all_preds = all_preds.type(torch.LongTensor)
-    all_targets = torch.tensor([])
-    all_targets = all_targets.type(torch.LongTensor)
     
-    with torch.no_grad():
+    with torch.inference_mode():
       self.fit_train_data(classes_group_idx, train_set)
       labels, preds = self.predict_test_data(classes_group_idx)
       accuracy = accuracy_score(labels, preds)
 
-      labels = torch.tensor(labels)
-      preds = torch.tensor(preds)
-      all_targets = torch.cat((all_targets.to(self.DEVICE), labels.to(self.DEVICE)), dim=0)
-      all_preds = torch.cat((all_preds.to(self.DEVICE), preds.to(self.DEVICE)), dim=0) 
+      all_targets = torch.as_tensor(labels, dtype=torch.long).to(self.DEVICE)
+      all_preds = torch.as_tensor(preds, dtype=torch.long).to(self.DEVICE)
 
     return accuracy, all_targets, all_preds
+
+
+class PrecomputedSVC:
+  # SVC fitted on a precomputed kernel, predicting through the kernel against the training features
+  
+  def __init__(self, clf, X_train, kernel_args):
+    self.clf = clf
+    self.X_train = X_train
+    self.kernel_args = kernel_args
+
+  @staticmethod
+  def kernel_args(grid, X):
+    # resolve the kernel hyperparameters of a grid point the same way SVC does
+    kernel = grid.get('kernel', 'rbf')
+    args = {'metric': kernel}
+    if kernel in ('rbf', 'poly', 'sigmoid'):
+      gamma = grid.get('gamma', 'scale')
+      if gamma == 'scale':
+        gamma = 1.0 / (X.shape[1] * X.var())
+      elif gamma == 'auto':
+        gamma = 1.0 / X.shape[1]
+      args['gamma'] = float(gamma)
+    if kernel == 'poly':
+      args['degree'] = grid.get('degree', 3)
+    if kernel in ('poly', 'sigmoid'):
+      args['coef0'] = grid.get('coef0', 0.0)
+    return args
+
+  def predict(self, X):
+    X = np.asarray(X, dtype=np.float64)
+    return self.clf.predict(pairwise_kernels(X, self.X_train, **self.kernel_args))
+
+
+def fit_precomputed_svc(grid, K_train, y_train, K_test, y_test):
+  params = {k: v for k, v in grid.items() if k not in ('kernel', 'gamma', 'degree', 'coef0')}
+  clf = SVC(kernel='precomputed', **params)
+  clf.fit(K_train, y_train)
+  score = accuracy_score(y_test, clf.predict(K_test))
+  return score, clf
+
+################################################################################################################
+
+class KNN_Classifier(iCaRL):
+  # k-nearest-neighbour vote over the exemplar features, searched through an IVF index that
+  # receives the exemplars of the new classes as groups arrive. The features of the old classes
+  # change with the network after every group: their vectors are replaced in the index, which
+  # re-trains its centroids once most of its vectors are new (see IVFIndex.remove)
+  
+  def __init__(self, device, net, LR, MOMENTUM, WEIGHT_DECAY, MILESTONES, GAMMA, train_dl, validation_dl, test_dl, BATCH_SIZE, train_subset, train_transform, test_transform, k=10, n_lists=None, n_probe=4):
+    super().__init__(device, net, LR, MOMENTUM, WEIGHT_DECAY, MILESTONES, GAMMA, train_dl, validation_dl, test_dl, BATCH_SIZE, train_subset, train_transform, test_transform)
+    self.K = k
+    self.index = IVFIndex(self.net.fc.in_features, n_lists=n_lists, n_probe=n_probe, device=self.DEVICE)
+    self.indexed_features = {}
+
+  def update_index(self):
+    # the exemplar features are taken from the class-mean cache, refreshed by mean_of_exemplars
+    num_classes = len(self.exemplar_set)
+    if any(i >= num_classes for i in self.indexed_features):
+      # fewer classes than indexed, the index is rebuilt
+      self.index.reset()
+      self.indexed_features = {}
+    features = {i: self.means_cache.entries[i]['features'] for i in range(num_classes)}
+    stale = [i for i in self.indexed_features if features[i] is not self.indexed_features[i]]
+    if len(stale) > 0:
+      self.index.remove(stale)
+    
+    for i in range(num_classes):
+      if i not in self.indexed_features or i in stale:
+        if features[i] is not None:
+          self.index.add(features[i], torch.full((features[i].size(0),), i, dtype=torch.long))
+        self.indexed_features[i] = features[i]
+
+  def classify(self, images, train_set=None):
+    feature_map = self.features_extractor(images)
+    feature_map = nn.functional.normalize(feature_map, p=2, dim=1)
+
+    if self.means is None:
+      self.mean_of_exemplars(train_set)
+    self.update_index()
+
+    dist, labels = self.index.search(feature_map, self.K)
+    # votes weighted by the inverse distance, missing neighbours (label -1) do not vote
+    weights = torch.where(labels >= 0, 1 / (dist + 1e-8), torch.zeros_like(dist))
+    votes = torch.zeros((feature_map.size(0), len(self.exemplar_set)), device=self.DEVICE)
+    votes.scatter_add_(1, labels.clamp(min=0), weights)
+    
+    return torch.argmax(votes, dim=1)
+
+################################################################################################################
+
+class Linear_Classifier(iCaRL):
+  # linear head (hinge or logistic loss) trained with SGD on the normalised features, warm-started
+  # from the previous group and extended with the new classes, so the fit cost per group is bounded
+  
+  def __init__(self, device, net, LR, MOMENTUM, WEIGHT_DECAY, MILESTONES, GAMMA, train_dl, validation_dl, test_dl, BATCH_SIZE, train_subset, train_transform, test_transform, loss='hinge', epochs=10, lr=0.01):
+    super().__init__(device, net, LR, MOMENTUM, WEIGHT_DECAY, MILESTONES, GAMMA, train_dl, validation_dl, test_dl, BATCH_SIZE, train_subset, train_transform, test_transform)
+    assert loss in ('hinge', 'log'), "loss must be 'hinge' or 'log'"
+    self.LINEAR_LOSS = loss
+    self.LINEAR_EPOCHS = epochs
+    self.LINEAR_LR = lr
+    self.clf = None
+
+  def checkpoint_state(self, classes_group_idx, logs):
+    state = super().checkpoint_state(classes_group_idx, logs)
+    # the head of the next group is warm-started from this one
+    state['clf'] = self.clf
+    return state
+
+  def load_checkpoint_state(self, state):
+    super().load_checkpoint_state(state)
+    self.clf = state['clf']
+
+  def extend_classifier(self, num_classes):
+    old_clf = self.clf
+    self.clf = nn.Linear(self.net.fc.in_features, num_classes).to(self.DEVICE)
+    if old_clf is not None:
+      # warm start from the weights of the previous group
+      self.clf.weight.data[:old_clf.out_features] = old_clf.weight.data
+      self.clf.bias.data[:old_clf.out_features] = old_clf.bias.data
+
+  def normalized_batch_features(self, images):
+    feature_map = self.features_extractor(images.to(self.DEVICE))
+    return nn.functional.normalize(feature_map, p=2, dim=1)
+    
+  def group_features(self, dataloader):
+    # normalised features of one pass over the loader (one fixed augmented view of every sample)
+    results = ResultCollector(loader_size(dataloader), self.DEVICE, features=torch.float32, labels=torch.long)
+    with torch.no_grad():
+      for _, images, labels in dataloader:
+        results.add('features', self.normalized_batch_features(images))
+        results.add('labels', labels.to(self.DEVICE))
+    return results.result('features'), results.result('labels')
+
+  @timed('classifier_fit')
+  def fit_train_data(self, classes_group_idx):
+    assert not self.LATENT_REPLAY, "the linear head is fitted on exemplar images, latent replay keeps none"
+    num_classes = len(self.exemplar_set)
+    if self.clf is None or self.clf.out_features < num_classes:
+      self.extend_classifier(num_classes)
+    
+    if self.LINEAR_LOSS == 'hinge':
+      criterion = nn.MultiMarginLoss()
+    else:
+      criterion = nn.CrossEntropyLoss()
+    optimizer = optim.SGD(self.clf.parameters(), lr=self.LINEAR_LR, momentum=self.MOMENTUM, weight_decay=self.WEIGHT_DECAY)
+    
+    # the backbone runs once per group, the epochs of the head run over the extracted features
+    dataloader = self.train_dl[classes_group_idx]
+    features, labels = self.group_features(dataloader)
+    self.clf.train()
+    for epoch in range(self.LINEAR_EPOCHS):
+      for batch in torch.randperm(features.size(0), device=self.DEVICE).split(dataloader.batch_size):
+        optimizer.zero_grad()
+        loss = criterion(self.clf(features[batch]), labels[batch])
+        loss.backward()
+        optimizer.step()
+    self.clf.train(False)
+  
+  @timed('test')
+  def test_classify(self, classes_group_idx, train_set):
+    self.best_net.train(False)
+    if self.old_net is not None: self.old_net.train(False)
+    
+    self.fit_train_data(classes_group_idx)
+    
+    dataloader = self.evaluation.loader(self.test_dl[classes_group_idx])
+    metrics = RunningMetrics(self.DEVICE)
+    results = ResultCollector(loader_size(dataloader), self.DEVICE, targets=torch.long, preds=torch.long)
+    
+    with torch.inference_mode():
+      for _, images, labels in self.timers.iterate(dataloader, 'test'):
+        labels = labels.to(self.DEVICE)
+        
+        preds = torch.argmax(self.clf(self.normalized_batch_features(images)), dim=1)
+        metrics.update(preds, labels.data)
+
+        results.add('targets', labels)
+        results.add('preds', preds)
+    
+    accuracy = metrics.accuracy()
+    return accuracy, results.result('targets'), results.result('preds')
@@ -6,8 +6,9 @@ from torch.backends import cudnn
 from torch.utils.data import DataLoader, ConcatDataset
 import numpy as np
 from math import floor
-from copy import copy, deepcopy
+from copy import copy
 from model.icarl import iCaRL
+from model.metrics import RunningMetrics
 from data.exemplar import Exemplar
 import random
 
@@ -15,7 +16,7 @@ class iCaRL_Loss(iCaRL):
   def __init__(self, device, net, LR, MOMENTUM, WEIGHT_DECAY, MILESTONES, GAMMA, train_dl, validation_dl, test_dl, BATCH_SIZE, train_subset, train_transform, test_transform):
     super().__init__(device, net, LR, MOMENTUM, WEIGHT_DECAY, MILESTONES, GAMMA, train_dl, validation_dl, test_dl, BATCH_SIZE, train_subset, train_transform, test_transform)
   
-  def train_model(self, num_epochs, loss, weight, feat):
+  def train_model(self, num_epochs, loss, weight, feat, resume=None):
     
     cudnn.benchmark
     
@@ -25,9 +26,14 @@ class iCaRL_Loss(iCaRL):
              'test_accuracies': [float for j in range(10)],
              'true_labels': [int],
              'val_accuracies': [float for j in range(10)],
-             'val_losses': [float for j in range(10)]}
+             'val_losses': [float for j in range(10)],
+             'epochs_saved': [int for j in range(10)],
+             'profile': [dict for j in range(10)]}
+    config = self.run_config(num_epochs, loss, weight, feat)
+    start, logs = self.resume_run(resume, logs, config)
     
-    for g in range(10):
+    for g in range(start, 10):
+      self.timers.reset()
       self.net.to(self.DEVICE)
       if self.old_net is not None: self.old_net = self.old_net.to(self.DEVICE)
       
@@ -35,32 +41,10 @@ class iCaRL_Loss(iCaRL):
       self.optimizer = optim.SGD(self.parameters_to_optimize, lr=self.START_LR, momentum=self.MOMENTUM, weight_decay=self.WEIGHT_DECAY)
       self.scheduler = optim.lr_scheduler.MultiStepLR(self.optimizer, milestones=self.MILESTONES, gamma=self.GAMMA)
       
-      best_acc = 0
-      self.best_net = deepcopy(self.net)
-      
       # augment train_set with exemplars and define DataLoaders for the current group
       self.update_representation(g)
 
-      for epoch in range(num_epochs):
-        e_loss, e_acc = self.train_epoch(g, loss, weight, feat)
-        e_print = epoch + 1
-        print(f"Epoch {e_print}/{num_epochs} LR: {self.scheduler.get_last_lr()}")
-        
-        validate_loss, validate_acc = self.validate(g)
-        g_print = g + 1
-        print(f"Validation accuracy on group {g_print}/10: {validate_acc:.2f}")
-        self.scheduler.step()
-        
-        if self.VALIDATE and validate_acc > best_acc:
-          best_acc = validate_acc
-          self.best_net = deepcopy(self.net)
-          best_epoch = epoch
-          print("Best model updated")
-        print("")
-        
-      print(f"Group {g_print} Finished!")
-      be_print = best_epoch + 1
-      print(f"Best accuracy found at epoch {be_print}: {best_acc:.2f}")
+      e_loss, e_acc, validate_loss, validate_acc = self.train_group(g, num_epochs, 10, loss, weight, feat)
       
       m = self.reduce_exemplar_set()
       self.construct_exemplar_set(self.train_set[g], m, False)
@@ -74,25 +58,36 @@ class iCaRL_Loss(iCaRL):
       logs['group_train_accuracies'][g] = e_acc
       logs['val_losses'][g] = validate_loss
       logs['val_accuracies'][g] = validate_acc
+      logs['epochs_saved'][g] = self.epochs_saved[g]
       logs['test_accuracies'][g] = test_accuracy
 
       if g < 9:
         self.add_output_nodes()
-        self.old_net = deepcopy(self.best_net)
+        self.old_net = self.make_teacher(self.best_net, g)
+      logs['profile'][g] = self.group_profile(g)
+
+      logs['true_labels'] = true_targets
+      logs['predictions'] = predictions
+      self.save_run(resume, g, logs, config)
 
-    logs['true_labels'] = true_targets
-    logs['predictions'] = predictions
     return logs
   
+  def first_task_objective(self, dist_loss, weight, feat):
+    # with a distillation loss the classification loss is the cross-entropy, otherwise the iCaRL BCE
+    return 'ce' if dist_loss in ('cosine', 'l2', 'l1') else 'bce'
+  
   def train_epoch(self, classes_group_idx, dist_loss, weight, feat):
     self.net.train()
     if self.old_net is not None: self.old_net.train(False)
     if self.best_net is not None: self.best_net.train(False)
-    running_loss = 0
-    running_corrects = 0
-    total = 0
+    self.set_view_epoch(classes_group_idx)
+    metrics = RunningMetrics(self.DEVICE)
 
-    for _, images, labels in self.train_dl[classes_group_idx]:
+    # targets of the teacher needed by the selected loss, prefetched in pipelined mode
+    feature_loss = feat is not False and dist_loss in ('cosine', 'l2', 'l1')
+    targets = ('features',) if feature_loss else ('outputs',)
+    
+    for keys, images, labels in self.timers.iterate(self.teacher_batches(classes_group_idx, targets), 'train'):
       self.optimizer.zero_grad()
 
       images = images.to(self.DEVICE)
@@ -100,50 +95,48 @@ class iCaRL_Loss(iCaRL):
 
       num_classes = self.net.fc.out_features
       
-      if dist_loss is not None:
-        if dist_loss == 'cosine':
-          dist_criterion = nn.CosineEmbeddingLoss()
-        elif dist_loss == 'l2':
-          dist_criterion = nn.MSELoss()
-        elif dist_loss == 'l1':
-          dist_criterion = nn.L1Loss()
-        else:
-          dist_criterion = None
-        if feat is False:
-          # Compute the loss between the outputs of the fully-connected layer
-          output, loss = self.compute_loss(images, labels, num_classes, dist_loss, dist_criterion, weight)
+      with self.autocast():
+        if dist_loss is not None:
+          if dist_loss == 'cosine':
+            dist_criterion = nn.CosineEmbeddingLoss()
+          elif dist_loss == 'l2':
+            dist_criterion = nn.MSELoss()
+          elif dist_loss == 'l1':
+            dist_criterion = nn.L1Loss()
+          else:
+            dist_criterion = None
+          if feat is False:
+            # Compute the loss between the outputs of the fully-connected layer
+            output, loss = self.compute_loss(images, labels, num_classes, dist_loss, dist_criterion, weight, keys)
+          else:
+            # Compute the loss among the extracted features
+            output, loss = self.compute_loss_features(images, labels, num_classes, dist_loss, dist_criterion, weight, keys)
         else:
-          # Compute the loss among the extracted features
-          output, loss = self.compute_loss_features(images, labels, num_classes, dist_loss, dist_criterion, weight)
-      else:
-        one_hot_labels = self.onehot_encoding(labels)[:, num_classes-10: num_classes]
-        output, loss = self.distill_loss(images, one_hot_labels, num_classes)
+          one_hot_labels = self.onehot_encoding(labels)[:, num_classes-10: num_classes]
+          output, loss = self.distill_loss(images, one_hot_labels, num_classes, keys)
 
-      running_loss += loss.item()
       _, preds = torch.max(output.data, 1)
-      running_corrects += torch.sum(preds == labels.data).data.item()
-      total += labels.size(0)
+      metrics.update(preds, labels.data, loss)
       
       loss.backward()
       self.optimizer.step()
       
     else:
-      epoch_loss = running_loss/len(self.train_dl[classes_group_idx])
-      epoch_acc = running_corrects/float(total)
+      epoch_loss = metrics.mean_loss(len(self.train_dl[classes_group_idx]))
+      epoch_acc = metrics.accuracy()
       #print("traing_loss = {0}".format(epoch_loss))
       
     return epoch_loss, epoch_acc
   
 ###############################################################################################################
   
-  def compute_loss(self, images, labels, num_classes, dist_loss, dist_criterion, weight):
+  def compute_loss(self, images, labels, num_classes, dist_loss, dist_criterion, weight, keys=None):
     if dist_criterion is not None:
       class_criterion = nn.CrossEntropyLoss()
 
       if self.old_net is not None:
         self.old_net.to(self.DEVICE)    
-        sigmoid = nn.Sigmoid()
-        old_net_output = sigmoid(self.old_net(images))[:, :num_classes-10]
+        old_net_output = self.teacher_outputs(images, keys)[:, :num_classes-10]
         output = self.net(images)
         if dist_loss == 'cosine':
           dist_loss = dist_criterion(output[:,:num_classes-10], old_net_output, torch.ones(images.shape[0]).to(self.DEVICE))
@@ -157,10 +150,10 @@ class iCaRL_Loss(iCaRL):
         loss = class_criterion(output, labels)      
     else:
       one_hot_labels = self.onehot_encoding(labels)[:, num_classes-10: num_classes]
-      output, loss = self.distill_loss(images, one_hot_labels, num_classes)   
+      output, loss = self.distill_loss(images, one_hot_labels, num_classes, keys)   
     return output, loss
   
-  def compute_loss_features(self, images, labels, num_classes, dist_loss, dist_criterion, weight):
+  def compute_loss_features(self, images, labels, num_classes, dist_loss, dist_criterion, weight, keys=None):
     if dist_criterion is not None:
       class_criterion = nn.CrossEntropyLoss()
 
@@ -170,10 +163,8 @@ class iCaRL_Loss(iCaRL):
         lamda = weight * np.sqrt(num_new_classes/num_old_classes)
         
         self.old_net.to(self.DEVICE)
-        output = self.net(images)
-        old_features = self.old_net.features(images)
-        old_features = nn.functional.normalize(old_features, p=2, dim=1)
-        new_features = self.net.features(images)
+        output, new_features = self.net.forward_with_features(images)
+        old_features = self.teacher_features(images, keys)
         new_features = nn.functional.normalize(new_features, p=2, dim=1)
         if dist_loss == 'cosine':
           dist_loss = dist_criterion(new_features, old_features, torch.ones(images.shape[0]).to(self.DEVICE))
@@ -187,7 +178,7 @@ class iCaRL_Loss(iCaRL):
         loss = class_criterion(output, labels)      
     else:
       one_hot_labels = self.onehot_encoding(labels)[:, num_classes-10: num_classes]
-      output, loss = self.distill_loss(images, one_hot_labels, num_classes)   
+      output, loss = self.distill_loss(images, one_hot_labels, num_classes, keys)   
     return output, loss
     
     
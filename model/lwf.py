@@ -6,14 +6,28 @@ from torch.backends import cudnn
 import numpy as np
 from copy import copy, deepcopy
 from model.trainer import Trainer
+from model.metrics import RunningMetrics
+from model.teacher import TeacherCache, TeacherPipeline, with_views, freeze_teacher
+from model.profiling import timed
 
 class LearningWithoutForgetting(Trainer):
   
   def __init__(self, device, net, LR, MOMENTUM, WEIGHT_DECAY, MILESTONES, GAMMA, train_dl, validation_dl, test_dl):
     super().__init__(device, net, LR, MOMENTUM, WEIGHT_DECAY, MILESTONES, GAMMA, train_dl, validation_dl, test_dl)
     self.old_net = None
+    # number of fixed augmentation views whose teacher outputs are cached, 0 disables the cache
+    self.TEACHER_VIEWS = 0
+    self.teacher_cache = None
+    # compute the teacher outputs of the next batch in a background thread during the student step
+    self.PIPELINE_TEACHER = False
+    self.TEACHER_THREADS = None
+    self.STUDENT_THREADS = None
+    self.prefetched_teacher = None
+    # None keeps a plain copy of the best network as teacher, otherwise one of 'fp32', 'bf16', 'int8'
+    self.TEACHER_PRECISION = None
+    self.TEACHER_TOLERANCE = 0.02
   
-  def train_model(self, num_epochs):
+  def train_model(self, num_epochs, resume=None):
     cudnn.benchmark
     
     logs = {'group_train_loss': [float for j in range(10)],
@@ -22,38 +36,22 @@ class LearningWithoutForgetting(Trainer):
              'test_accuracies': [float for j in range(10)],
              'true_labels': [int],
              'val_accuracies': [float for j in range(10)],
-             'val_losses': [float for j in range(10)]}
+             'val_losses': [float for j in range(10)],
+             'epochs_saved': [int for j in range(10)],
+             'profile': [dict for j in range(10)]}
+    config = self.run_config(num_epochs)
+    start, logs = self.resume_run(resume, logs, config)
     
-    for g in range(10):
+    for g in range(start, 10):
+      self.timers.reset()
       self.net.to(self.DEVICE)
+      self.prepare_teacher_cache(g)
       
       self.parameters_to_optimize = self.net.parameters()
       self.optimizer = optim.SGD(self.parameters_to_optimize, lr=self.START_LR, momentum=self.MOMENTUM, weight_decay=self.WEIGHT_DECAY)
       self.scheduler = optim.lr_scheduler.MultiStepLR(self.optimizer, milestones=self.MILESTONES, gamma=self.GAMMA)
 
-      best_acc = 0
-      self.best_net = deepcopy(self.net)
-
-      for epoch in range(num_epochs):
-        e_loss, e_acc = self.train_epoch(g)
-        e_print = epoch + 1
-        print(f"Epoch {e_print}/{num_epochs} LR: {self.scheduler.get_last_lr()}")
-        
-        validate_loss, validate_acc = self.validate(g)
-        g_print = g + 1
-        print(f"Validation accuracy on group {g_print}/10: {validate_acc:.2f}")
-        self.scheduler.step()
-        
-        if validate_acc > best_acc:
-          best_acc = validate_acc
-          self.best_net = deepcopy(self.net)
-          best_epoch = epoch
-          print("Best model updated")
-        print("")
-        
-      print(f"Group {g_print} Finished!")
-      be_print = best_epoch + 1
-      print(f"Best accuracy found at epoch {be_print}: {best_acc:.2f}")
+      e_loss, e_acc, validate_loss, validate_acc = self.train_group(g, num_epochs, 10)
       test_accuracy, true_targets, predictions = self.test(g)
       print(f"Testing classes seen so far, accuracy: {test_accuracy:.2f}")
       print("")
@@ -63,25 +61,37 @@ class LearningWithoutForgetting(Trainer):
       logs['group_train_accuracies'][g] = e_acc
       logs['val_losses'][g] = validate_loss
       logs['val_accuracies'][g] = validate_acc
+      logs['epochs_saved'][g] = self.epochs_saved[g]
       logs['test_accuracies'][g] = test_accuracy
 
       if g < 9:
         self.add_output_nodes()
-        self.old_net = deepcopy(self.best_net)
+        self.old_net = self.make_teacher(self.best_net, g)
+      logs['profile'][g] = self.group_profile(g)
+
+      logs['true_labels'] = true_targets
+      logs['predictions'] = predictions
+      self.save_run(resume, g, logs, config)
 
-    logs['true_labels'] = true_targets
-    logs['predictions'] = predictions
     return logs
 
+  def checkpoint_state(self, classes_group_idx, logs):
+    state = super().checkpoint_state(classes_group_idx, logs)
+    state['old_net'] = self.old_net
+    return state
+
+  def load_checkpoint_state(self, state):
+    super().load_checkpoint_state(state)
+    self.old_net = state['old_net']
+
   def train_epoch(self, classes_group_idx):
     self.net.train()
     if self.old_net is not None: self.old_net.train(False)
     if self.best_net is not None: self.best_net.train(False)
-    running_loss = 0
-    running_corrects = 0
-    total = 0
+    self.set_view_epoch(classes_group_idx)
+    metrics = RunningMetrics(self.DEVICE)
 
-    for _, images, labels in self.train_dl[classes_group_idx]:
+    for keys, images, labels in self.timers.iterate(self.teacher_batches(classes_group_idx), 'train'):
       self.optimizer.zero_grad()
 
       images = images.to(self.DEVICE)
@@ -90,30 +100,102 @@ class LearningWithoutForgetting(Trainer):
       num_classes = self.net.fc.out_features
       one_hot_labels = self.onehot_encoding(labels)[:, num_classes-10: num_classes]
       
-      output, loss = self.distill_loss(images, one_hot_labels, num_classes)
+      with self.autocast():
+        output, loss = self.distill_loss(images, one_hot_labels, num_classes, keys)
 
-      running_loss += loss.item()
       _, preds = torch.max(output.data, 1)
-      running_corrects += torch.sum(preds == labels.data).data.item()
-      total += labels.size(0)
+      metrics.update(preds, labels.data, loss)
       
       loss.backward()
       self.optimizer.step()
       
     else:
-      epoch_loss = running_loss/len(self.train_dl[classes_group_idx])
-      epoch_acc = running_corrects/float(total)
+      epoch_loss = metrics.mean_loss(len(self.train_dl[classes_group_idx]))
+      epoch_acc = metrics.accuracy()
       
     return epoch_loss, epoch_acc
 
-  def distill_loss(self, images, one_hot_labels, num_classes):
+  def distill_loss(self, images, one_hot_labels, num_classes, keys=None):
     if self.old_net is not None:
       self.old_net.to(self.DEVICE)    
-      sigmoid = nn.Sigmoid()
-      old_net_output = sigmoid(self.old_net(images))[:, :num_classes-10]  
+      old_net_output = self.teacher_outputs(images, keys)[:, :num_classes-10]  
       one_hot_labels = torch.cat((old_net_output, one_hot_labels), dim=1)   
     
     output = self.net(images)   
     loss = self.criterion(output, one_hot_labels)
     
     return output, loss
+
+  
+########## TEACHER OUTPUTS ######################################################
+  
+  def make_teacher(self, net, classes_group_idx):
+    if self.TEACHER_PRECISION is None:
+      return self.compiled(self.formatted(deepcopy(net)))
+    # a validation batch of the group checks the reduced-precision teacher against the fp32 one
+    _, images, _ = next(iter(self.validation_dl[classes_group_idx]))
+    return self.compiled(self.formatted(freeze_teacher(net, self.TEACHER_PRECISION, images.to(self.DEVICE), self.TEACHER_TOLERANCE)))
+
+  def prepare_teacher_cache(self, classes_group_idx):
+    # called at the start of a group, once old_net and the group DataLoader are final
+    self.teacher_cache = None
+    if self.TEACHER_VIEWS > 0 and self.old_net is not None:
+      self.train_dl[classes_group_idx] = with_views(self.train_dl[classes_group_idx], self.TEACHER_VIEWS)
+      size = len(self.train_dl[classes_group_idx].dataset) * self.TEACHER_VIEWS
+      self.teacher_cache = TeacherCache(size, self.DEVICE)
+
+  def teacher_batches(self, classes_group_idx, targets=('outputs',)):
+    # batches of the group DataLoader, with the teacher `targets` computed one batch ahead in pipelined mode
+    dataloader = self.train_dl[classes_group_idx]
+    if not self.PIPELINE_TEACHER or self.old_net is None:
+      yield from dataloader
+      return
+
+    def compute(keys, images):
+      images = images.to(self.DEVICE)
+      prefetched = {}
+      if 'outputs' in targets: prefetched['outputs'] = self.compute_teacher_outputs(images, keys)
+      if 'features' in targets: prefetched['features'] = self.compute_teacher_features(images, keys)
+      return images, prefetched
+
+    num_threads = torch.get_num_threads()
+    if self.STUDENT_THREADS is not None: torch.set_num_threads(self.STUDENT_THREADS)
+    try:
+      for keys, labels, images, prefetched in TeacherPipeline(dataloader, compute, self.TEACHER_THREADS):
+        self.prefetched_teacher = prefetched
+        yield keys, images, labels
+    finally:
+      self.prefetched_teacher = None
+      torch.set_num_threads(num_threads)
+
+  def teacher_outputs(self, images, keys=None):
+    # sigmoid of the outputs of old_net for the current batch
+    if self.prefetched_teacher is not None and 'outputs' in self.prefetched_teacher:
+      return self.prefetched_teacher['outputs']
+    return self.compute_teacher_outputs(images, keys)
+
+  def teacher_features(self, images, keys=None):
+    # L2-normalised features of old_net for the current batch
+    if self.prefetched_teacher is not None and 'features' in self.prefetched_teacher:
+      return self.prefetched_teacher['features']
+    return self.compute_teacher_features(images, keys)
+
+  # the precision of the teacher is set by TEACHER_PRECISION, not by the autocast of the student
+
+  @timed('teacher')
+  def compute_teacher_outputs(self, images, keys=None):
+    def compute(x):
+      with torch.no_grad(), torch.autocast(x.device.type, enabled=False):
+        return torch.sigmoid(self.old_net(x))
+    if keys is None or self.teacher_cache is None:
+      return compute(images)
+    return self.teacher_cache.fetch('outputs', keys, images, compute)
+
+  @timed('teacher')
+  def compute_teacher_features(self, images, keys=None):
+    def compute(x):
+      with torch.no_grad(), torch.autocast(x.device.type, enabled=False):
+        return nn.functional.normalize(self.old_net.features(x), p=2, dim=1)
+    if keys is None or self.teacher_cache is None:
+      return compute(images)
+    return self.teacher_cache.fetch('features', keys, images, compute)
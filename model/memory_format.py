@@ -0,0 +1,42 @@
+import torch
+from torch.utils.data import DataLoader, RandomSampler
+from torch.utils.data.dataloader import default_collate
+
+# channels_last (NHWC) execution of ResNet-32. A convolution runs its NHWC kernels only when
+# both its weight and its input are NHWC, and converts the input otherwise. The networks and
+# teachers are converted once, and the batches are built in channels_last by the collate function
+# of the DataLoaders, in the loader workers, so .to(device) keeps their layout and the training
+# and evaluation loops never convert a batch. Loaders rebuilt from another one (views, activation
+# caches, evaluation batch size) keep its collate function.
+
+
+def to_channels_last(x):
+  if torch.is_tensor(x) and x.dim() == 4 and x.is_floating_point():
+    return x.contiguous(memory_format=torch.channels_last)
+  return x
+
+
+class ChannelsLastCollate:
+  # collate function of a DataLoader, returning the image batches (4-d float tensors) in channels_last
+
+  def __init__(self, collate_fn=default_collate):
+    self.collate_fn = collate_fn
+
+  def __call__(self, samples):
+    batch = self.collate_fn(samples)
+    if isinstance(batch, (list, tuple)):
+      return type(batch)(to_channels_last(x) for x in batch)
+    return to_channels_last(batch)
+
+
+def channels_last_loader(dataloader):
+  # same loader, collating its batches in channels_last
+  if not isinstance(dataloader, DataLoader) or isinstance(dataloader.collate_fn, ChannelsLastCollate):
+    return dataloader
+  return DataLoader(dataloader.dataset,
+                    batch_size=dataloader.batch_size,
+                    shuffle=isinstance(dataloader.sampler, RandomSampler),
+                    num_workers=dataloader.num_workers,
+                    collate_fn=ChannelsLastCollate(dataloader.collate_fn),
+                    pin_memory=dataloader.pin_memory,
+                    drop_last=dataloader.drop_last)
@@ -0,0 +1,74 @@
+import torch
+import torch.distributed as dist
+
+# Running loss and accuracy of an epoch, accumulated on the device.
+# Reading a tensor with .item() waits for every queued kernel to finish; the loops add
+# the batch loss and number of correct predictions to device tensors instead, and the
+# values are read once, when the epoch results are computed.
+
+class RunningMetrics:
+
+  def __init__(self, device):
+    self.loss = torch.zeros((), dtype=torch.float64, device=device)
+    self.corrects = torch.zeros((), dtype=torch.long, device=device)
+    # batch sizes are known on the host, counting them needs no synchronisation
+    self.total = 0
+    # batches of all the ranks, once reduced
+    self.num_batches = None
+
+  def update(self, preds, targets, loss=None):
+    self.corrects += torch.sum(preds == targets)
+    self.total += targets.size(0)
+    if loss is not None:
+      self.loss += loss.detach()
+
+  def all_reduce(self, num_batches):
+    # sums of all the ranks of a sharded pass (see model.distributed), the shards can differ by a batch
+    counts = torch.tensor([float(self.total), float(num_batches)], dtype=torch.float64, device=self.loss.device)
+    totals = torch.cat([torch.stack([self.loss, self.corrects.double()]), counts])
+    dist.all_reduce(totals)
+    self.loss = totals[0]
+    self.corrects = totals[1].long()
+    self.total = int(totals[2].item())
+    self.num_batches = int(totals[3].item())
+
+  def accuracy(self):
+    return self.corrects.item() / float(self.total)
+
+  def mean_loss(self, num_batches):
+    if self.num_batches is not None:
+      num_batches = self.num_batches
+    return self.loss.item() / num_batches
+
+
+def loader_size(*dataloaders):
+  # upper bound of the number of samples drawn from the DataLoaders in one pass
+  return sum(len(dataloader.sampler) for dataloader in dataloaders)
+
+
+class ResultCollector:
+  # Per-sample results of an evaluation pass (targets, predictions, scores, features), written
+  # batch by batch into buffers preallocated for `size` samples. Every result has the dtype given
+  # at construction; its buffer is allocated on the first batch, with the trailing shape of the
+  # batch, and results are returned as views of the filled part.
+
+  def __init__(self, size, device, **dtypes):
+    self.size = size
+    self.device = device
+    self.dtypes = dtypes
+    self.buffers = {}
+    self.lengths = dict.fromkeys(dtypes, 0)
+
+  def add(self, name, values):
+    if name not in self.buffers:
+      self.buffers[name] = torch.empty((self.size,) + tuple(values.shape[1:]), dtype=self.dtypes[name], device=self.device)
+    start = self.lengths[name]
+    end = start + values.size(0)
+    assert end <= self.size, f"more than {self.size} results collected for '{name}'"
+    self.buffers[name][start:end] = values
+    self.lengths[name] = end
+
+  def result(self, name):
+    if name not in self.buffers:
+      return torch.empty(0, dtype=self.dtypes[name], device=self.device)
+    return self.buffers[name][:self.lengths[name]]
@@ -8,6 +8,8 @@ import numpy as np
 from math import floor
 from copy import copy, deepcopy
 from model.icarl import iCaRL
+from model.metrics import ResultCollector, loader_size
+from model.profiling import timed
 from data.exemplar import Exemplar
 import random
 from math import sqrt
@@ -39,7 +41,7 @@ class owrEnsemble(iCaRL):
     self.strategy = strategy
 
   
-  def train_model(self, num_epochs):
+  def train_model(self, num_epochs, resume=None):
     
     cudnn.benchmark
     
@@ -48,16 +50,25 @@ class owrEnsemble(iCaRL):
              'test_accuracies': [[] for j in range(5)],
              'true_labels': [],
              'open_values': [float for j in range(5)],
-             'closed_values': [float for j in range(5)]}
+             'closed_values': [float for j in range(5)],
+             'profile': [dict for j in range(5)]}
 
-    ensemble = SnapshotEnsembleOWRClassifier(estimator=self.net, n_estimators=self.n_estimators, estimator_args=None, cuda=True)
-    ensemble.set_optimizer('SGD',             # parameter optimizer
+    self.ensemble = SnapshotEnsembleOWRClassifier(estimator=self.net, n_estimators=self.n_estimators, estimator_args=None, cuda=True)
+    self.ensemble.set_optimizer('SGD',             # parameter optimizer
                     lr=self.START_LR,            # learning rate of the optimizer
                     weight_decay=self.WEIGHT_DECAY,
                     momentum=self.MOMENTUM)  # weight decay of the optimizer
     logger = set_logger('classification_mnist_mlp')
+    config = self.run_config(num_epochs)
+    # a resumed run continues with the ensemble of the checkpoint (estimators and old ensemble)
+    start, logs = self.resume_run(resume, logs, config)
+    ensemble = self.ensemble
+    ensemble.autocast_dtype = torch.bfloat16 if self.BF16_AUTOCAST else None
+    ensemble.memory_format = self.memory_format
+    ensemble.phase_timer = self.timers
     
-    for g in range(5):
+    for g in range(start, 5):
+      self.timers.reset()
       self.net.to(self.DEVICE)
       
       self.parameters_to_optimize = self.net.parameters()
@@ -70,15 +81,20 @@ class owrEnsemble(iCaRL):
       
       # augment train_set with exemplars and define DataLoaders for the current group
       self.update_representation(g)
-
-      ensemble.fit(self.train_dl[g],
-                   lr_clip=None,
-                   epochs=num_epochs,
-                   log_interval=num_epochs,
-                   test_loader=self.validation_dl[g],
-                   save_model=False,
-                   save_dir=None,
-                   classes_group_idx = g)
+      self.format_loaders()
+      self.formatted(self.net)
+
+      with self.training_threads(), self.timers.phase('train'):
+        ensemble.fit(self.train_dl[g],
+                     lr_clip=None,
+                     epochs=num_epochs,
+                     log_interval=num_epochs,
+                     test_loader=self.validation_dl[g],
+                     save_model=False,
+                     save_dir=None,
+                     classes_group_idx = g)
+      if self.TEACHER_PRECISION is not None:
+        ensemble.old_ensemble.estimators_ = nn.ModuleList([self.make_teacher(estimator, g) for estimator in ensemble.old_ensemble.estimators_])
 
         
       print(f"Group {g+1} Finished!")
@@ -113,16 +129,30 @@ class owrEnsemble(iCaRL):
 
       if g < 4:
         self.add_output_nodes()
+      logs['profile'][g] = self.group_profile(g)
+
+      logs['true_labels'] = true_targets
+      logs['predictions'] = predictions
+      self.save_run(resume, g, logs, config)
 
-    logs['true_labels'] = true_targets
-    logs['predictions'] = predictions
     return logs
 
+  def checkpoint_state(self, classes_group_idx, logs):
+    state = super().checkpoint_state(classes_group_idx, logs)
+    # pickled with the networks of the trainer, so its base estimator stays self.net
+    state['ensemble'] = self.ensemble
+    return state
+
+  def load_checkpoint_state(self, state):
+    super().load_checkpoint_state(state)
+    self.ensemble = state['ensemble']
+
 ################################################################
 
 
+  @timed('open_set_test')
   def harmonic_test(self, classes_group_idx, ensemble):
-    with torch.no_grad():
+    with torch.inference_mode():
       ensemble.train(False)
       mean_accs = []
       open_test_accuracy, open_true_targets, open_predictions_list, open_all_values= self.test_openset(classes_group_idx, ensemble)
@@ -136,6 +166,7 @@ class owrEnsemble(iCaRL):
     return mean_accs, open_test_accuracy, closed_test_accuracy, open_true_targets, closed_true_targets, open_predictions_list, closed_predictions_list, open_all_values, closed_all_values       
 
 
+  @timed('open_set_test')
   def test_openset(self,classes_group_idx, ensemble):
     softmax = nn.Softmax(dim=1).to(self.DEVICE)
     threshold_list = self.threshold_list
@@ -145,15 +176,14 @@ class owrEnsemble(iCaRL):
     unknowkn_class = 101 #Assign  index 100 to unknown class
 
     
-    all_targets = torch.tensor([])
-    all_targets = all_targets.type(torch.LongTensor)
-    all_values = torch.tensor([])
-    all_values = all_values.type(torch.LongTensor)
-    preds_with_unknown_list = [torch.tensor([]) for _ in range(len(threshold_list))]
+    # the predictions for threshold k are collected as 'preds{k}'
+    dataloaders = [self.evaluation.loader(self.test_dl[i]) for i in range(5,10)]
+    results = ResultCollector(loader_size(*dataloaders), self.DEVICE, targets=torch.long, values=torch.float32,
+                              **{f'preds{k}': torch.float32 for k in range(len(threshold_list))})
 
 
-    for i in range(5,10):
-      for _, images, labels in self.test_dl[i]:
+    for dataloader in dataloaders:
+      for _, images, labels in self.timers.iterate(dataloader, 'open_set_test'):
         images = images.to(self.DEVICE)
         labels = labels.to(self.DEVICE)
         total += labels.size(0)
@@ -161,14 +191,11 @@ class owrEnsemble(iCaRL):
         outputs, variances = ensemble.predict_with_variance(images)
 
         values, preds = torch.max(outputs.data, 1)
-        pred_vars = torch.tensor([])
-        pred_vars = pred_vars.type(torch.DoubleTensor)
-        pred_vars = pred_vars.to(self.DEVICE)
-        for en,pred in enumerate(preds):
-          pred_vars = torch.cat((pred_vars.to(self.DEVICE), torch.tensor([variances[en,pred]]).to(self.DEVICE)))
-
-        all_values = torch.cat((all_values.to(self.DEVICE),values.to(self.DEVICE)))
-        all_targets = torch.cat((all_targets.to(self.DEVICE), labels.to(self.DEVICE)), dim=0)
+        # variance of the predicted class of every sample
+        pred_vars = variances.gather(1, preds.unsqueeze(1)).squeeze(1).to(self.DEVICE, torch.float64)
+
+        results.add('values', values)
+        results.add('targets', labels)
         label_unknow_tensor = torch.tensor([unknowkn_class for _ in range(labels.size(0))]).to(self.DEVICE)
         for k,threshold in enumerate(threshold_list):
           stats = (values - threshold)/(torch.sqrt(pred_vars)/sqrt(self.n_estimators))
@@ -181,16 +208,18 @@ class owrEnsemble(iCaRL):
             below_mask = stats < self.confidence
           preds_with_unknown = torch.where(below_mask.to(self.DEVICE), torch.tensor(unknowkn_class).to(self.DEVICE), preds.to(self.DEVICE))
           running_corrects_list[k] += torch.sum(preds_with_unknown == label_unknow_tensor.data).data.item()
-          preds_with_unknown_list[k] = torch.cat((preds_with_unknown_list[k].to(self.DEVICE), preds_with_unknown.to(self.DEVICE)), dim=0)
+          results.add(f'preds{k}', preds_with_unknown)
           
 
     for corr in running_corrects_list:
       accuracies.append(corr/float(total))
 
 
-    return accuracies, all_targets, preds_with_unknown_list, all_values
+    preds_with_unknown_list = [results.result(f'preds{k}') for k in range(len(threshold_list))]
+    return accuracies, results.result('targets'), preds_with_unknown_list, results.result('values')
 
   
+  @timed('open_set_test')
   def test_rejection(self, classes_group_idx, ensemble):
     softmax = nn.Softmax(dim=1).to(self.DEVICE)
     threshold_list = self.threshold_list
@@ -200,13 +229,11 @@ class owrEnsemble(iCaRL):
     #unknowkn_class = classes_group_idx*10+10 #Assign an index to unknown class, for instance at the first iteration we have class from 0 to 9, unkown class will be 10
     unknowkn_class = 100
     
-    all_targets = torch.tensor([])
-    all_targets = all_targets.type(torch.LongTensor)
-    all_values = torch.tensor([])
-    all_values = all_values.type(torch.LongTensor)
-    preds_with_unknown_list = [torch.tensor([]) for _ in range(len(threshold_list))]
+    dataloader = self.evaluation.loader(self.test_dl[classes_group_idx])
+    results = ResultCollector(loader_size(dataloader), self.DEVICE, targets=torch.long, values=torch.float32,
+                              **{f'preds{k}': torch.float32 for k in range(len(threshold_list))})
 
-    for _, images, labels in self.test_dl[classes_group_idx]:
+    for _, images, labels in self.timers.iterate(dataloader, 'open_set_test'):
       images = images.to(self.DEVICE)
       labels = labels.to(self.DEVICE)
       total += labels.size(0)
@@ -214,14 +241,11 @@ class owrEnsemble(iCaRL):
       outputs, variances = ensemble.predict_with_variance(images)
 
       values, preds = torch.max(outputs.data, 1)
-      pred_vars = torch.tensor([])
-      pred_vars = pred_vars.type(torch.DoubleTensor)
-      pred_vars = pred_vars.to(self.DEVICE)
-      for en,pred in enumerate(preds):
-        pred_vars = torch.cat((pred_vars.to(self.DEVICE), torch.tensor([variances[en,pred]]).to(self.DEVICE)))
-
-      all_values = torch.cat((all_values.to(self.DEVICE),values.to(self.DEVICE)))
-      all_targets = torch.cat((all_targets.to(self.DEVICE), labels.to(self.DEVICE)), dim=0)
+      # variance of the predicted class of every sample
+      pred_vars = variances.gather(1, preds.unsqueeze(1)).squeeze(1).to(self.DEVICE, torch.float64)
+
+      results.add('values', values)
+      results.add('targets', labels)
       for k,threshold in enumerate(threshold_list):
         stats = (values - threshold)/(torch.sqrt(pred_vars)/sqrt(self.n_estimators))
         if self.strategy == 'mean' or self.strategy == 'hybrid': 
@@ -233,12 +257,13 @@ class owrEnsemble(iCaRL):
             below_mask = stats < self.confidence
         preds_with_unknown = torch.where(below_mask.to(self.DEVICE), torch.tensor(unknowkn_class).to(self.DEVICE), preds.to(self.DEVICE))
         running_corrects_list[k] += torch.sum(preds_with_unknown == labels.data).data.item()
-        preds_with_unknown_list[k] = torch.cat((preds_with_unknown_list[k].to(self.DEVICE), preds_with_unknown.to(self.DEVICE)), dim=0)
+        results.add(f'preds{k}', preds_with_unknown)
         
         
     for corr in running_corrects_list:
       accuracies.append(corr/float(total))
 
 
-    return accuracies, all_targets, preds_with_unknown_list, all_values
+    preds_with_unknown_list = [results.result(f'preds{k}') for k in range(len(threshold_list))]
+    return accuracies, results.result('targets'), preds_with_unknown_list, results.result('values')
     
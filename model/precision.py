@@ -0,0 +1,60 @@
+import time
+import warnings
+import torch
+import torch.optim as optim
+
+# Accuracy parity of the bf16 autocast training mode (Trainer.BF16_AUTOCAST) with the fp32 path.
+# Two trainers are built from the same seed and trained on the first group with the same short
+# schedule, one in fp32 and one under bf16 autocast; the validation accuracies and the training
+# times of the two runs are compared. bf16_batch_check is the cheap check run by the trainers
+# when BF16_AUTOCAST is set (see Trainer.check_autocast): the loss and predictions of one batch
+# under autocast against fp32, before every group.
+
+
+def bf16_batch_check(net, criterion, images, targets, device_type):
+  # relative loss error and fraction of changed predictions of one batch under bf16 autocast
+  training = net.training
+  net.train(False)
+  with torch.no_grad():
+    output = net(images)
+    loss = criterion(output, targets).item()
+    with torch.autocast(device_type, dtype=torch.bfloat16):
+      bf16_output = net(images)
+    bf16_loss = criterion(bf16_output.float(), targets).item()
+  net.train(training)
+  loss_error = abs(bf16_loss - loss) / max(abs(loss), 1e-12)
+  changed = (output.argmax(dim=1) != bf16_output.argmax(dim=1)).float().mean().item()
+  return loss_error, changed
+
+
+def train_first_group(trainer, num_epochs, *epoch_args):
+  trainer.net.to(trainer.DEVICE)
+  trainer.optimizer = optim.SGD(trainer.net.parameters(), lr=trainer.START_LR, momentum=trainer.MOMENTUM, weight_decay=trainer.WEIGHT_DECAY)
+  trainer.scheduler = optim.lr_scheduler.MultiStepLR(trainer.optimizer, milestones=trainer.MILESTONES, gamma=trainer.GAMMA)
+  start = time.perf_counter()
+  _, _, _, val_acc = trainer.train_group(0, num_epochs, 1, *epoch_args)
+  return val_acc, time.perf_counter() - start
+
+
+def bf16_parity_check(make_trainer, num_epochs=2, *epoch_args, seed=0, tolerance=0.02):
+  """
+  make_trainer() returns a new trainer; epoch_args are passed to train_group (e.g. the
+  loss, weight and feat of iCaRL_Loss). Returns a dict with the validation accuracy and
+  the training time of both runs, and warns when the accuracies differ by more than
+  `tolerance`.
+  """
+  results = {}
+  for name, bf16 in (('fp32', False), ('bf16', True)):
+    torch.manual_seed(seed)
+    trainer = make_trainer()
+    trainer.BF16_AUTOCAST = bf16
+    # both runs have to train, not load the first group
+    trainer.FIRST_TASK_CACHE = None
+    results[name], results[name + '_time'] = train_first_group(trainer, num_epochs, *epoch_args)
+
+  results['difference'] = abs(results['bf16'] - results['fp32'])
+  print(f"bf16 autocast: validation accuracy {results['bf16']:.4f} ({results['bf16_time']:.1f}s), "
+        f"fp32 {results['fp32']:.4f} ({results['fp32_time']:.1f}s)")
+  if results['difference'] > tolerance:
+    warnings.warn(f"bf16 autocast accuracy differs from fp32 by {results['difference']:.4f}, more than the tolerance {tolerance}", RuntimeWarning)
+  return results
@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from collections import defaultdict
+import torch
+
+# Phase timers of a run. Every trainer owns a PhaseTimer (Trainer.timers) and the expensive steps
+# of the methods run inside named phases: training epochs, data loading, teacher forwards,
+# validation, exemplar selection, class means, classifier fitting, tests. Phases nest: the time of
+# a phase is reported both inclusive and exclusive of the phases opened inside it, and the
+# exclusive times give the breakdown of the wall time of a group. Loops over a DataLoader go
+# through iterate(), which times the wait for each batch as 'data' and counts the images of the
+# phase, for its images/sec. The timers only read the clock; while a torch.profiler window is open
+# (see profile_window) the phases are also recorded as profiler ranges.
+# The teacher pipeline computes teacher outputs in a background thread: that time overlaps with
+# the training phase, so with a pipelined teacher the percentages can add up to more than 100.
+
+
+class PhaseTimer:
+
+  def __init__(self):
+    self.local = threading.local()
+    self.record = False
+    self.reset()
+
+  def reset(self):
+    self.inclusive = defaultdict(float)
+    self.exclusive = defaultdict(float)
+    self.calls = defaultdict(int)
+    self.images = defaultdict(int)
+    self.counters = defaultdict(int)
+    self.start = time.perf_counter()
+
+  def stack(self):
+    if not hasattr(self.local, 'stack'):
+      self.local.stack = []
+    return self.local.stack
+
+  @contextmanager
+  def phase(self, name):
+    stack = self.stack()
+    if any(frame[0] == name for frame in stack):
+      # re-entered (e.g. an override calling the method it overrides), already timed
+      yield
+      return
+    frame = [name, 0.0]
+    stack.append(frame)
+    record = torch.profiler.record_function(name) if self.record else None
+    if record is not None:
+      record.__enter__()
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      elapsed = time.perf_counter() - start
+      if record is not None:
+        record.__exit__(None, None, None)
+      stack.pop()
+      self.inclusive[name] += elapsed
+      self.exclusive[name] += elapsed - frame[1]
+      self.calls[name] += 1
+      if stack:
+        stack[-1][1] += elapsed
+
+  def count(self, name, n=1):
+    self.counters[name] += n
+
+  def iterate(self, batches, name):
+    # batches of a DataLoader (or a generator over one), the wait for each one timed as 'data'
+    iterator = iter(batches)
+    while True:
+      with self.phase('data'):
+        try:
+          batch = next(iterator)
+        except StopIteration:
+          return
+      self.images[name] += len(batch[-1])
+      yield batch
+
+  def summary(self):
+    wall = time.perf_counter() - self.start
+    phases = {}
+    for name in self.inclusive:
+      phases[name] = {
+        'seconds': self.inclusive[name],
+        'exclusive_seconds': self.exclusive[name],
+        'percent': 100.0 * self.exclusive[name] / wall if wall > 0 else 0.0,
+        'calls': self.calls[name]
+      }
+      if self.images[name] > 0:
+        phases[name]['images'] = self.images[name]
+        phases[name]['images_per_sec'] = self.images[name] / self.inclusive[name] if self.inclusive[name] > 0 else 0.0
+    other = wall - sum(p['exclusive_seconds'] for p in phases.values())
+    return {'seconds': wall, 'phases': phases, 'other_percent': 100.0 * max(other, 0.0) / wall if wall > 0 else 0.0,
+            'counters': dict(self.counters)}
+
+
+def timed(name):
+  # runs a method of a trainer (or of anything with a `timers` PhaseTimer) inside the phase `name`
+  def decorator(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+      with self.timers.phase(name):
+        return method(self, *args, **kwargs)
+    return wrapper
+  return decorator
+
+
+def print_summary(summary, title):
+  print(f"{title}: {summary['seconds']:.1f}s")
+  for name, p in sorted(summary['phases'].items(), key=lambda item: -item[1]['exclusive_seconds']):
+    throughput = f", {p['images_per_sec']:.0f} images/sec" if 'images_per_sec' in p else ""
+    print(f"  {name:<16} {p['seconds']:8.1f}s {p['percent']:5.1f}%  x{p['calls']}{throughput}")
+  print(f"  {'other':<16} {'':>9} {summary['other_percent']:5.1f}%")
+
+
+def append_summary(summary, path, **fields):
+  # one JSON line per group
+  directory = os.path.dirname(path)
+  if directory:
+    os.makedirs(directory, exist_ok=True)
+  with open(path, 'a') as f:
+    f.write(json.dumps(dict(fields, **summary)) + '\n')
+
+
+@contextmanager
+def profile_window(timers, trace_path=None, row_limit=15):
+  # torch.profiler capture of the enclosed code, with the phases of `timers` as ranges
+  activities = [torch.profiler.ProfilerActivity.CPU]
+  if torch.cuda.is_available():
+    activities.append(torch.profiler.ProfilerActivity.CUDA)
+  timers.record = True
+  try:
+    with torch.profiler.profile(activities=activities) as prof:
+      yield prof
+  finally:
+    timers.record = False
+  # the report and the trace take seconds, timed apart from the phases they describe
+  with timers.phase('profiler'):
+    print(prof.key_averages().table(sort_by='self_cpu_time_total', row_limit=row_limit))
+    if trace_path is not None:
+      directory = os.path.dirname(trace_path)
+      if directory:
+        os.makedirs(directory, exist_ok=True)
+      prof.export_chrome_trace(trace_path)
@@ -69,6 +69,7 @@ class ResNet(nn.Module):
         self.layer2 = self._make_layer(block, 32, layers[1], stride=2)
         self.layer3 = self._make_layer(block, 64, layers[2], stride=2)
         self.avgpool = nn.AvgPool2d(8, stride=1)
+        self.input_stage = None
         # last classifier layer (head) with as many outputs as classes
         self.fc = nn.Linear(64 * block.expansion, num_classes)
         # and `head_var` with the name of the head, so it can be removed when doing incremental learning experiments
@@ -96,23 +97,36 @@ class ResNet(nn.Module):
         return nn.Sequential(*layers)
 
     def forward(self, x):
-        x = self.relu(self.bn1(self.conv1(x)))
-        x = self.layer1(x)
-        x = self.layer2(x)
+        return self.fc(self.features(x))
+
+    def features(self, x):
+        # with `input_stage` set, x holds the activations of that stage instead of images
+        stage = getattr(self, 'input_stage', None)
+        if stage is None:
+            x = self.relu(self.bn1(self.conv1(x)))
+        if stage in (None, 'conv1'):
+            x = self.layer1(x)
+        if stage in (None, 'conv1', 'layer1'):
+            x = self.layer2(x)
         x = self.layer3(x)
         x = self.avgpool(x)
         x = x.view(x.size(0), -1)
-        x = self.fc(x)
         return x
-    
-    def features(self, x):
+
+    def stem(self, x, stage='layer1'):
+        # activations of the images x at the output of `stage` ('conv1', 'layer1' or 'layer2')
         x = self.relu(self.bn1(self.conv1(x)))
+        if stage == 'conv1':
+            return x
         x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x = self.avgpool(x)
-        x = x.view(x.size(0), -1)
-        return x
+        if stage == 'layer1':
+            return x
+        return self.layer2(x)
+
+    def forward_with_features(self, x):
+        # single pass through the backbone returning both the outputs and the features
+        features = self.features(x)
+        return self.fc(features), features
     
     #(custom - 18-05-21)add output nodes
     def addOutputNodes(self, num_new_outputs):
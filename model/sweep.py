@@ -0,0 +1,218 @@
+import os
+import json
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import torch
+from sklearn.model_selection import ParameterGrid
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# Sweep over the distillation-loss ablations of iCaRL_Loss (loss, weight, feat) and seeds.
+# Runs are scheduled across processes; every process builds the datasets and splits of a
+# seed once and reuses them for all the runs of that seed it receives, and all runs share
+# the first-group cache, which is filled by a first wave of one run per (seed, objective)
+# before the remaining runs start. Results are collected by the parent into one JSON store.
+#
+# run_seeds runs every (method, seed) pair of a set of methods in its own process. The cores
+# available to the parent are partitioned among the processes of the pool: every process is
+# pinned to its core set and gets a matching budget of intra-op threads and DataLoader workers.
+# The first group of a seed is the same for every method, so with a first-group cache a first
+# wave of one run per seed fills it before the other methods of the seed start.
+
+_data = {}
+_budget = {}
+
+
+def run_name(point, seed):
+  return ','.join(f"{k}={point[k]}" for k in sorted(point)) + f",seed={seed}"
+
+
+def to_serializable(logs):
+  if isinstance(logs, torch.Tensor):
+    return logs.cpu().tolist()
+  if isinstance(logs, dict):
+    return {k: to_serializable(v) for k, v in logs.items()}
+  if isinstance(logs, (list, tuple)):
+    return [to_serializable(v) for v in logs]
+  if isinstance(logs, type):
+    # placeholders of the logs dict that were never filled
+    return None
+  return logs
+
+
+def load_store(path):
+  if path is not None and os.path.isfile(path):
+    with open(path) as f:
+      return json.load(f)
+  return {}
+
+
+def save_store(store, path):
+  # merged into the store on disk under an exclusive lock: several processes (sweeps, tune_threads)
+  # can write the same store, each keeps the entries of the others and wins on its own
+  with open(path + '.lock', 'w') as lock:
+    if fcntl is not None:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+    merged = load_store(path)
+    merged.update(store)
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path) or '.')
+    try:
+      with os.fdopen(fd, 'w') as f:
+        json.dump(merged, f)
+      os.replace(tmp_path, path)
+    except BaseException:
+      os.remove(tmp_path)
+      raise
+  store.update(merged)
+  return store
+
+
+def core_partitions(processes):
+  # contiguous, disjoint core sets, one per process
+  cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+  processes = max(1, min(processes, len(cores)))
+  size, extra = divmod(len(cores), processes)
+  partitions, start = [], 0
+  for i in range(processes):
+    end = start + size + (i < extra)
+    partitions.append(cores[start:end])
+    start = end
+  return partitions
+
+
+def _pin_process(partitions, loader_workers):
+  # pool initializer: takes the next free core set and sizes the thread and worker budgets on it
+  cores = partitions.get()
+  if hasattr(os, 'sched_setaffinity'):
+    os.sched_setaffinity(0, cores)
+  workers = loader_workers if loader_workers is not None else min(4, len(cores) // 4)
+  _budget['workers'] = workers
+  _budget['threads'] = max(1, len(cores) - workers)
+  torch.set_num_threads(_budget['threads'])
+
+
+def apply_worker_budget(trainer, dataloaders):
+  # the loader worker processes inherit the core set of the process that starts them
+  if 'workers' not in _budget:
+    return
+  for dataloader in dataloaders:
+    dataloader.num_workers = _budget['workers']
+  trainer.NUM_WORKERS = _budget['workers']
+
+
+def _run(make_data, make_trainer, point, seed, num_epochs, first_task_cache, num_threads):
+  if num_threads is not None:
+    torch.set_num_threads(num_threads)
+  if seed not in _data:
+    _data[seed] = make_data(seed)
+  # the lists are copied because the trainers replace the loaders of the groups they train
+  train_dl, val_dl, test_dl, train_set = [list(d) for d in _data[seed]]
+
+  torch.manual_seed(seed)
+  trainer = make_trainer(train_dl, val_dl, test_dl, train_set)
+  trainer.FIRST_TASK_CACHE = first_task_cache
+  trainer.SEED = seed
+  logs = trainer.train_model(num_epochs, point['loss'], point['weight'], point['feat'])
+  return to_serializable(logs)
+
+
+def run_loss_sweep(make_data, make_trainer, grid, seeds, num_epochs, store_path, processes=None, first_task_cache=None, start_method='fork'):
+  """
+  make_data(seed) returns the (train_dl, val_dl, test_dl, train_set) lists of a seed,
+  make_trainer(train_dl, val_dl, test_dl, train_set) a new iCaRL_Loss trainer and
+  grid is a dict of lists for 'loss', 'weight' and 'feat' (see ParameterGrid).
+  Runs already in the store are skipped.
+  """
+  store = load_store(store_path)
+  runs = [(point, seed) for seed in seeds for point in ParameterGrid(grid) if run_name(point, seed) not in store]
+
+  processes = processes if processes is not None else min(len(runs), os.cpu_count()) or 1
+  num_threads = max(1, os.cpu_count() // processes)
+
+  # first wave: one run for every (seed, first-group objective), filling the first-group cache
+  first_wave, second_wave, seen = [], [], set()
+  for point, seed in runs:
+    objective = (seed, point['loss'] in ('cosine', 'l2', 'l1'))
+    if first_task_cache is not None and objective not in seen:
+      seen.add(objective)
+      first_wave.append((point, seed))
+    else:
+      second_wave.append((point, seed))
+
+  context = multiprocessing.get_context(start_method)
+  with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+    for wave in (first_wave, second_wave):
+      futures = {executor.submit(_run, make_data, make_trainer, point, seed, num_epochs, first_task_cache, num_threads): run_name(point, seed)
+                 for point, seed in wave}
+      for future in as_completed(futures):
+        store[futures[future]] = future.result()
+        save_store(store, store_path)
+        print(f"Sweep run {futures[future]} finished ({len(store)} in store)")
+  return store
+
+
+def _run_method(make_data, make_trainer, train_args, seed, first_task_cache, resume):
+  if seed not in _data:
+    _data[seed] = make_data(seed)
+  train_dl, val_dl, test_dl, train_set = [list(d) for d in _data[seed]]
+
+  torch.manual_seed(seed)
+  trainer = make_trainer(train_dl, val_dl, test_dl, train_set)
+  apply_worker_budget(trainer, train_dl + val_dl + test_dl)
+  trainer.FIRST_TASK_CACHE = first_task_cache
+  trainer.SEED = seed
+  if resume is not None:
+    logs = trainer.train_model(*train_args, resume=resume)
+  else:
+    logs = trainer.train_model(*train_args)
+  return to_serializable(logs)
+
+
+def run_seeds(make_data, methods, seeds, store_path, processes=None, loader_workers=None, first_task_cache=None,
+              checkpoint_dir=None, start_method='fork'):
+  """
+  methods maps a method name to (make_trainer, train_args): make_trainer(train_dl, val_dl,
+  test_dl, train_set) returns a new trainer and train_args are the arguments of its
+  train_model; make_data(seed) returns the (train_dl, val_dl, test_dl, train_set) lists
+  of a seed. Every (method, seed) run is a task of a pool of `processes` pinned processes
+  (by default one per run, up to the number of cores); loader_workers sets the DataLoader
+  workers of every process (by default a quarter of its cores, at most 4). With a
+  checkpoint_dir every run checkpoints its groups there and resumes from them.
+  Runs already in the store are skipped.
+  """
+  store = load_store(store_path)
+  runs = [(name, seed) for seed in seeds for name in methods if f"{name},seed={seed}" not in store]
+  if len(runs) == 0:
+    return store
+
+  # first wave: one run for every seed, filling the first-group cache
+  first_wave, second_wave, seen = [], [], set()
+  for name, seed in runs:
+    if first_task_cache is not None and seed not in seen:
+      seen.add(seed)
+      first_wave.append((name, seed))
+    else:
+      second_wave.append((name, seed))
+
+  partitions = core_partitions(processes if processes is not None else len(runs))
+  context = multiprocessing.get_context(start_method)
+  queue = context.Queue()
+  for cores in partitions:
+    queue.put(cores)
+
+  with ProcessPoolExecutor(max_workers=len(partitions), mp_context=context, initializer=_pin_process, initargs=(queue, loader_workers)) as executor:
+    for wave in (first_wave, second_wave):
+      futures = {}
+      for name, seed in wave:
+        make_trainer, train_args = methods[name]
+        resume = os.path.join(checkpoint_dir, f"{name},seed={seed}.pth") if checkpoint_dir is not None else None
+        future = executor.submit(_run_method, make_data, make_trainer, train_args, seed, first_task_cache, resume)
+        futures[future] = f"{name},seed={seed}"
+      for future in as_completed(futures):
+        store[futures[future]] = future.result()
+        save_store(store, store_path)
+        print(f"Run {futures[future]} finished ({len(store)} in store)")
+  return store
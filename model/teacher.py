@@ -0,0 +1,212 @@
+import math
+import queue
+import threading
+import warnings
+import torch
+import torch.nn as nn
+from copy import deepcopy
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.ao.quantization import quantize_dynamic
+from torch.utils.data import Dataset, DataLoader, RandomSampler
+
+# Caching of the outputs of the frozen teacher (old_net) used by the distillation losses.
+# The training set is wrapped in a ViewDataset, which draws every sample under one of
+# n_views fixed augmentations (the view used in an epoch is epoch % n_views) and returns a
+# key identifying the (sample, view) pair in place of the dataset index. The teacher outputs
+# for a key never change within a group, so they are computed once and served from compact
+# fp16 arrays for the remaining epochs.
+
+class ViewDataset(Dataset):
+
+  def __init__(self, dataset, n_views, seed=0):
+    self.dataset = dataset
+    self.n_views = n_views
+    self.seed = seed
+    self.epoch = 0
+
+  def set_epoch(self, epoch):
+    self.epoch = epoch
+
+  def __getitem__(self, index):
+    view = self.epoch % self.n_views
+    # the random augmentation of a (sample, view) pair is reproducible across epochs
+    with torch.random.fork_rng(devices=[]):
+      torch.manual_seed(self.seed + index * self.n_views + view)
+      _, img, target = self.dataset[index]
+    return index * self.n_views + view, img, target
+
+  def __len__(self):
+    return len(self.dataset)
+
+
+def with_views(dataloader, n_views, seed=0):
+  # same loader, over the (sample, view) wrapped dataset
+  return DataLoader(ViewDataset(dataloader.dataset, n_views, seed),
+                    batch_size=dataloader.batch_size,
+                    shuffle=isinstance(dataloader.sampler, RandomSampler),
+                    num_workers=dataloader.num_workers,
+                    collate_fn=dataloader.collate_fn,
+                    drop_last=dataloader.drop_last)
+
+
+class TeacherCache:
+
+  def __init__(self, size, device):
+    self.size = size
+    self.device = device
+    self.store = {}
+
+  def fetch(self, name, keys, images, compute):
+    # outputs `name` of the teacher for the batch, computing only the (sample, view) keys never seen
+    keys = keys.to(self.device)
+    if name in self.store:
+      values, filled = self.store[name]
+      miss = ~filled[keys]
+    else:
+      values, filled = None, None
+      miss = torch.ones(keys.size(0), dtype=torch.bool, device=self.device)
+
+    if miss.any():
+      with torch.no_grad():
+        new_values = compute(images[miss])
+      if values is None:
+        values = torch.zeros((self.size,) + tuple(new_values.shape[1:]), dtype=torch.float16, device=self.device)
+        filled = torch.zeros(self.size, dtype=torch.bool, device=self.device)
+        self.store[name] = (values, filled)
+      values[keys[miss]] = new_values.to(torch.float16)
+      filled[keys[miss]] = True
+
+    return values[keys].float()
+
+
+class TeacherPipeline:
+  # Iterates over a DataLoader while a background thread computes the teacher outputs one
+  # batch ahead, so the teacher forward of batch k+1 overlaps with the student step of batch k.
+  # `threads` sets the intra-op threads of the teacher thread (the setting is per calling thread).
+
+  def __init__(self, dataloader, compute, threads=None, depth=1):
+    self.dataloader = dataloader
+    self.compute = compute
+    self.threads = threads
+    self.depth = depth
+
+  def _put(self, batches, stop, item):
+    while not stop.is_set():
+      try:
+        batches.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+  def _worker(self, batches, stop):
+    try:
+      if self.threads is not None:
+        torch.set_num_threads(self.threads)
+      for keys, images, labels in self.dataloader:
+        if not self._put(batches, stop, (keys, labels) + self.compute(keys, images)):
+          return
+      self._put(batches, stop, None)
+    except BaseException as e:
+      self._put(batches, stop, e)
+
+  def __iter__(self):
+    batches = queue.Queue(maxsize=self.depth)
+    stop = threading.Event()
+    worker = threading.Thread(target=self._worker, args=(batches, stop), daemon=True)
+    worker.start()
+    try:
+      while True:
+        item = batches.get()
+        if item is None:
+          break
+        if isinstance(item, BaseException):
+          raise item
+        yield item
+    finally:
+      stop.set()
+      worker.join()
+
+  def __len__(self):
+    return len(self.dataloader)
+
+
+########## INFERENCE-ONLY TEACHERS ##############################################
+
+def fold_batchnorm(net):
+  # fold every BatchNorm2d that follows a Conv2d into the convolution (in eval mode)
+  for module in net.modules():
+    for i in (1, 2, 3):
+      conv, bn = getattr(module, f'conv{i}', None), getattr(module, f'bn{i}', None)
+      if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+        setattr(module, f'conv{i}', fuse_conv_bn_eval(conv, bn))
+        setattr(module, f'bn{i}', nn.Identity())
+    if isinstance(module, nn.Sequential):
+      for j in range(len(module) - 1):
+        if isinstance(module[j], nn.Conv2d) and isinstance(module[j+1], nn.BatchNorm2d):
+          module[j] = fuse_conv_bn_eval(module[j], module[j+1])
+          module[j+1] = nn.Identity()
+  return net
+
+
+class FrozenTeacher(nn.Module):
+  # eval-only wrapper running the network in `dtype` (on `device`, when the network is bound to one)
+  # and returning fp32 outputs on the device of the batch
+
+  def __init__(self, net, dtype=torch.float32, device=None):
+    super().__init__()
+    self.net = net
+    self.dtype = dtype
+    self.device = device
+
+  def train(self, mode=True):
+    return super().train(False)
+
+  def input(self, x):
+    return x.to(self.device if self.device is not None else x.device, self.dtype)
+
+  def forward(self, x):
+    return self.net(self.input(x)).float().to(x.device)
+
+  def features(self, x):
+    return self.net.features(self.input(x)).float().to(x.device)
+
+  def forward_with_features(self, x):
+    output, features = self.net.forward_with_features(self.input(x))
+    return output.float().to(x.device), features.float().to(x.device)
+
+
+def freeze_teacher(net, precision=None, images=None, tolerance=0.02):
+  # Inference-only copy of `net` with BatchNorm folded into the convolutions and, optionally,
+  # reduced precision: 'bf16' runs the whole network in bfloat16, 'int8' applies dynamic int8
+  # quantization, which only replaces nn.Linear modules (the fc head; the convolutions stay fp32).
+  # Quantized modules run on the CPU: an int8 teacher moves its batches there and returns its
+  # outputs on their device. When a batch of `images` is given, the sigmoid outputs and normalised
+  # features are compared with the fp32 network and the reduced-precision teacher is only kept if
+  # they differ by less than `tolerance` (a NaN error rejects it too).
+  assert precision in (None, 'fp32', 'bf16', 'int8'), "precision must be one of None, 'fp32', 'bf16', 'int8'"
+  assert precision != 'int8' or isinstance(net.fc, nn.Linear), "int8 quantizes the nn.Linear head only, this network has another head"
+  reference = deepcopy(net).eval()
+  for p in reference.parameters():
+    p.requires_grad = False
+  folded = fold_batchnorm(deepcopy(reference))
+  
+  if precision == 'bf16':
+    teacher = FrozenTeacher(folded.to(torch.bfloat16), torch.bfloat16)
+  elif precision == 'int8':
+    teacher = FrozenTeacher(quantize_dynamic(folded.cpu(), {nn.Linear}, dtype=torch.qint8), device=torch.device('cpu'))
+  else:
+    teacher = FrozenTeacher(folded)
+
+  if images is not None and precision in ('bf16', 'int8'):
+    with torch.no_grad():
+      images = images.to(next(reference.parameters()).device)
+      outputs_error = (torch.sigmoid(teacher(images)) - torch.sigmoid(reference(images))).abs().max().item()
+      features_error = (nn.functional.normalize(teacher.features(images), p=2, dim=1)
+                        - nn.functional.normalize(reference.features(images), p=2, dim=1)).abs().max().item()
+    print(f"{precision} teacher: max output error {outputs_error:.4f}, max feature error {features_error:.4f}")
+    if not all(math.isfinite(error) and error <= tolerance for error in (outputs_error, features_error)):
+      warnings.warn(f"{precision} teacher exceeds the tolerance {tolerance}, falling back to fp32", RuntimeWarning)
+      teacher = FrozenTeacher(fold_batchnorm(reference))
+
+  return teacher.eval()
@@ -1,9 +1,25 @@
+import os
+import math
+import warnings
 import torch
 import torch.nn as nn
 import torch.nn.init as init
 import torch.optim as optim
 from torch.backends import cudnn
+from torch.utils.data import RandomSampler
 from copy import copy, deepcopy
+from contextlib import contextmanager, nullcontext
+from model.best_model import BestModelTracker
+from model.metrics import RunningMetrics, ResultCollector, loader_size
+from model.evaluation import EvaluationEngine
+from model.checkpoints import FirstTaskCache, RunCheckpoint, config_hash, dataset_indices, network_definition, rng_state, set_rng_state
+from model.activations import FROZEN_STAGES, build_activation_cache, freeze_stages, set_input_stage
+from model.compiled import compile_network, enable_compile_cache
+from model.memory_format import channels_last_loader
+from model.epoch_budget import EpochBudget
+from model.precision import bf16_batch_check
+from model.profiling import PhaseTimer, append_summary, print_summary, profile_window, timed
+from model.distributed import broadcast_module, broadcast_object, is_main_process, process_rank, shard_loader, split_loader, synchronize_optimizer, world_size
 
 #(self, device, net, param_opt, LR, MOMENTUM, WEIGHT_DECAY, MILESTONES, GAMMA, train_dl, val_dl, test_dl)
 #(self, device, net, criterion, optimizer, scheduler, train_dl, validation_dl, test_dl):
@@ -20,6 +36,7 @@ class Trainer(torch.nn.Module):
 
     self.net = net
     self.best_net = self.net
+    self.best_tracker = BestModelTracker()
 
     self.criterion = nn.BCEWithLogitsLoss().to(self.DEVICE)
     self.parameters_to_optimize = self.net.parameters()
@@ -30,8 +47,57 @@ class Trainer(torch.nn.Module):
     self.train_dl = train_dl
     self.validation_dl = validation_dl
     self.test_dl = test_dl
+    self.VALIDATE = True
+
+    # directory of the content-addressed cache of first-group models (None disables it)
+    self.FIRST_TASK_CACHE = None
+    self.SEED = None
+
+    # groups after FREEZE_AFTER_GROUP train with conv1 and layer1 (also layer2 when FROZEN_STAGE is 'layer2')
+    # frozen, from their activations cached on disk for ACTIVATION_VIEWS augmentation views; None disables it
+    self.FREEZE_AFTER_GROUP = None
+    self.FROZEN_STAGE = 'layer1'
+    self.ACTIVATION_VIEWS = 2
+    self.ACTIVATION_DIR = None
+    self.view_epoch = 0
+
+    # validation and test passes: inference mode, optional evaluation batch size and BN-folded copies
+    self.evaluation = EvaluationEngine()
+    # run the training forward passes under bf16 autocast (see autocast); before every group one
+    # validation batch is compared with fp32, and training falls back to fp32 when the loss or the
+    # predictions differ by more than BF16_TOLERANCE (see check_autocast)
+    self.BF16_AUTOCAST = False
+    self.BF16_TOLERANCE = 0.02
+    # compile net, best_net and the teachers stage by stage (see model.compiled), with the
+    # compiled graphs cached in COMPILE_CACHE_DIR (None keeps the default cache directory)
+    self.COMPILE = False
+    self.COMPILE_BACKEND = 'inductor'
+    self.COMPILE_CACHE_DIR = None
+    # run the networks, the teachers and the batches in channels_last memory format (see model.memory_format)
+    self.CHANNELS_LAST = False
+    # epoch budget of a group (see model.epoch_budget): after PLATEAU_PATIENCE epochs without a validation
+    # improvement above PLATEAU_MIN_DELTA the next milestone is brought forward, or the group ends when none
+    # is left; GROUP_TIME_BUDGET limits the training time of a group in seconds. None disables them.
+    self.PLATEAU_PATIENCE = None
+    self.PLATEAU_MIN_DELTA = 0.0
+    self.GROUP_TIME_BUDGET = None
+    self.epochs_saved = {}
+    # DataLoader workers of the loaders built by the trainer
+    self.NUM_WORKERS = 4
+    # tuned threads and workers of the training and evaluation phases (see model.tuning), None keeps the defaults
+    self.thread_settings = None
+    # data-parallel training over the ranks of an initialized gloo process group (see model.distributed)
+    self.DISTRIBUTED = False
+    self.validation_shards = {}
+    # phase timers (see model.profiling), summarised per group in logs['profile'] and appended to PROFILE_LOG
+    # (a JSON lines file, None only logs them); PROFILE_WINDOW = (group, epoch) captures that epoch with
+    # torch.profiler, its trace written to PROFILE_TRACE
+    self.timers = PhaseTimer()
+    self.PROFILE_LOG = None
+    self.PROFILE_WINDOW = None
+    self.PROFILE_TRACE = None
     
-  def train_model(self, num_epochs):
+  def train_model(self, num_epochs, resume=None):
     cudnn.benchmark
     
     logs = {'group_train_loss': [float for j in range(10)],
@@ -40,38 +106,21 @@ class Trainer(torch.nn.Module):
              'test_accuracies': [float for j in range(10)],
              'true_labels': [int],
              'val_accuracies': [float for j in range(10)],
-             'val_losses': [float for j in range(10)]}
+             'val_losses': [float for j in range(10)],
+             'epochs_saved': [int for j in range(10)],
+             'profile': [dict for j in range(10)]}
+    config = self.run_config(num_epochs)
+    start, logs = self.resume_run(resume, logs, config)
     
-    for g in range(10):
+    for g in range(start, 10):
+      self.timers.reset()
       self.net.to(self.DEVICE)
       
       self.parameters_to_optimize = self.net.parameters()
       self.optimizer = optim.SGD(self.parameters_to_optimize, lr=self.START_LR, momentum=self.MOMENTUM, weight_decay=self.WEIGHT_DECAY)
       self.scheduler = optim.lr_scheduler.MultiStepLR(self.optimizer, milestones=self.MILESTONES, gamma=self.GAMMA)
 
-      best_acc = 0
-      self.best_net = deepcopy(self.net)
-
-      for epoch in range(num_epochs):
-        e_loss, e_acc = self.train_epoch(g)
-        e_print = epoch + 1
-        print(f"Epoch {e_print}/{num_epochs} LR: {self.scheduler.get_last_lr()}")
-        
-        validate_loss, validate_acc = self.validate(g)
-        g_print = g + 1
-        print(f"Validation accuracy on group {g_print}/10: {validate_acc:.2f}")
-        self.scheduler.step()
-        
-        if validate_acc > best_acc:
-          best_acc = validate_acc
-          self.best_net = deepcopy(self.net)
-          best_epoch = epoch
-          print("Best model updated")
-        print("")
-        
-      print(f"Group {g_print} Finished!")
-      be_print = best_epoch + 1
-      print(f"Best accuracy found at epoch {be_print}: {best_acc:.2f}")
+      e_loss, e_acc, validate_loss, validate_acc = self.train_group(g, num_epochs, 10)
       test_accuracy, true_targets, predictions = self.test(g)
       print(f"Testing classes seen so far, accuracy: {test_accuracy:.2f}")
       print("")
@@ -81,102 +130,390 @@ class Trainer(torch.nn.Module):
       logs['group_train_accuracies'][g] = e_acc
       logs['val_losses'][g] = validate_loss
       logs['val_accuracies'][g] = validate_acc
+      logs['epochs_saved'][g] = self.epochs_saved[g]
       logs['test_accuracies'][g] = test_accuracy
 
       if g < 9:
         self.add_output_nodes()
+      logs['profile'][g] = self.group_profile(g)
+
+      logs['true_labels'] = true_targets
+      logs['predictions'] = predictions
+      self.save_run(resume, g, logs, config)
 
-    logs['true_labels'] = true_targets
-    logs['predictions'] = predictions
     return logs
 
+  def run_config(self, num_epochs, *epoch_args, **train_args):
+    # everything a checkpoint of the run depends on: the first-group config, the method and the arguments of its train_model
+    config = self.first_task_config(num_epochs, *epoch_args)
+    config['method'] = type(self).__name__
+    config['train_args'] = train_args
+    return config
+
+  def resume_run(self, resume, logs, config):
+    # first group to train and logs of the completed groups, from the checkpoint at `resume` when there is one
+    if resume is None:
+      return 0, logs
+    state = RunCheckpoint(resume).load(self.DEVICE)
+    if state is None:
+      return 0, logs
+    if state.get('config_hash') != config_hash(config):
+      raise ValueError(f"{resume} is the checkpoint of another run configuration, refusing to resume from it")
+    self.load_checkpoint_state(state)
+    print(f"Resumed from {resume}: {state['group'] + 1} groups completed")
+    return state['group'] + 1, state['logs']
+
+  def save_run(self, resume, classes_group_idx, logs, config):
+    # called once group classes_group_idx is complete, with the network ready for the next group
+    # the ranks of a distributed run hold the same state, rank 0 writes it
+    if resume is not None and is_main_process():
+      state = self.checkpoint_state(classes_group_idx, logs)
+      state['config'] = config
+      state['config_hash'] = config_hash(config)
+      RunCheckpoint(resume).save(state)
+
+  def checkpoint_state(self, classes_group_idx, logs):
+    return {
+      'group': classes_group_idx,
+      'logs': logs,
+      'net': self.net,
+      'best_net': self.best_net,
+      'optimizer': self.optimizer,
+      'scheduler': self.scheduler,
+      'epochs_saved': self.epochs_saved,
+      'rng': rng_state()
+    }
+
+  def load_checkpoint_state(self, state):
+    self.net = state['net']
+    self.best_net = state['best_net']
+    self.optimizer = state['optimizer']
+    self.scheduler = state['scheduler']
+    self.epochs_saved = state['epochs_saved']
+    set_rng_state(state['rng'])
+
+  def train_group(self, classes_group_idx, num_epochs, num_groups, *epoch_args):
+    g = classes_group_idx
+    self.format_loaders()
+    self.compiled(self.formatted(self.net))
+    if self.BF16_AUTOCAST:
+      self.check_autocast(g)
+    if g == 0 and self.FIRST_TASK_CACHE is not None:
+      cache = FirstTaskCache(self.FIRST_TASK_CACHE)
+      config = self.first_task_config(num_epochs, *epoch_args)
+      key = config_hash(config)
+      entry = cache.load(key, self.DEVICE)
+      if entry is not None:
+        print(f"First group loaded from cache {key[:12]}")
+        self.net.load_state_dict(entry['net'])
+        self.best_net = self.compiled(deepcopy(self.net))
+        self.best_net.load_state_dict(entry['best_net'])
+        stats = entry['stats']
+        self.epochs_saved[g] = stats.get('epochs_saved', 0)
+        return stats['e_loss'], stats['e_acc'], stats['validate_loss'], stats['validate_acc']
+
+    frozen = self.FREEZE_AFTER_GROUP is not None and g > self.FREEZE_AFTER_GROUP
+    # loader of the group images, restored once the group is trained
+    images_dl = self.train_dl[g]
+    if frozen:
+      self.freeze_backbone(g)
+    if self.DISTRIBUTED:
+      # every rank starts from the network of rank 0 and trains on its shard of the group
+      broadcast_module(self.net)
+      synchronize_optimizer(self.optimizer)
+      self.train_dl[g] = shard_loader(self.train_dl[g], self.SEED or 0)
+
+    best_acc = 0
+    # -1: no epoch improved on the network the group started from
+    best_epoch = -1
+    budget = EpochBudget(num_epochs, self.scheduler, self.PLATEAU_PATIENCE, self.PLATEAU_MIN_DELTA, self.GROUP_TIME_BUDGET)
+    # the best network is snapshotted into preallocated storage and only materialized at the end of the group
+    self.best_tracker.update(self.net)
+
+    for epoch in range(num_epochs):
+      if self.DISTRIBUTED:
+        self.train_dl[g].sampler.set_epoch(epoch)
+      with self.frozen_input(frozen), self.training_threads(), self.profiled(g, epoch), self.timers.phase('train'):
+        e_loss, e_acc = self.train_epoch(g, *epoch_args)
+      self.timers.count('epochs')
+      if self.DISTRIBUTED:
+        broadcast_module(self.net, buffers_only=True)
+      e_print = epoch + 1
+      print(f"Epoch {e_print}/{num_epochs} LR: {self.scheduler.get_last_lr()}")
+      
+      validate_loss, validate_acc = self.validate(g)
+      g_print = g + 1
+      print(f"Validation accuracy on group {g_print}/{num_groups}: {validate_acc:.2f}")
+      stop = budget.update(validate_acc)
+      if self.DISTRIBUTED:
+        # the time budget is measured on every rank, rank 0 decides
+        stop = broadcast_object(stop)
+      self.scheduler.step()
+      
+      if self.VALIDATE and validate_acc > best_acc:
+        best_acc = validate_acc
+        self.best_tracker.update(self.net)
+        best_epoch = epoch
+        print("Best model updated")
+      print("")
+      if stop:
+        print(f"Stopped after {budget.epochs}/{num_epochs} epochs ({budget.reason}), {budget.saved_epochs} epochs saved")
+        break
+      
+    self.epochs_saved[g] = budget.saved_epochs
+    self.best_net = self.compiled(self.best_tracker.materialize(self.net))
+    print(f"Group {g_print} Finished!")
+    be_print = best_epoch + 1
+    print(f"Best accuracy found at epoch {be_print}: {best_acc:.2f}")
+
+    # later steps of the group (exemplars, classifiers) read the whole group of images again
+    self.train_dl[g] = images_dl
+
+    if g == 0 and self.FIRST_TASK_CACHE is not None and is_main_process():
+      stats = {'e_loss': e_loss, 'e_acc': e_acc, 'validate_loss': validate_loss, 'validate_acc': validate_acc,
+               'epochs_saved': self.epochs_saved[g]}
+      cache.save(key, config, self.net, self.best_net, stats)
+    return e_loss, e_acc, validate_loss, validate_acc
+
+  def first_task_objective(self, *epoch_args):
+    # loss used on the first group, where no teacher is available yet
+    return 'bce'
+
+  def first_task_config(self, num_epochs, *epoch_args):
+    # everything the model trained on the first group depends on, independently of the method
+    config = {
+      'objective': self.first_task_objective(*epoch_args),
+      'hyperparameters': [self.START_LR, self.MOMENTUM, self.WEIGHT_DECAY, list(self.MILESTONES), self.GAMMA, num_epochs, self.train_dl[0].batch_size],
+      'validate': self.VALIDATE,
+      'seed': self.SEED if self.SEED is not None else torch.initial_seed(),
+      'train_split': sorted(dataset_indices(self.train_dl[0].dataset)),
+      'validation_split': sorted(dataset_indices(self.validation_dl[0].dataset)),
+      'network': network_definition(self.net),
+      'loader': {'shuffle': isinstance(self.train_dl[0].sampler, RandomSampler), 'drop_last': self.train_dl[0].drop_last},
+      # execution settings that change the numerics of the training
+      'execution': {'bf16_autocast': self.BF16_AUTOCAST,
+                    'world_size': world_size() if self.DISTRIBUTED else 1,
+                    'compile': [self.COMPILE, self.COMPILE_BACKEND] if self.COMPILE else False,
+                    'channels_last': self.CHANNELS_LAST}
+    }
+    if self.PLATEAU_PATIENCE is not None or self.GROUP_TIME_BUDGET is not None:
+      config['epoch_budget'] = [self.PLATEAU_PATIENCE, self.PLATEAU_MIN_DELTA, self.GROUP_TIME_BUDGET]
+    return config
+
+  @timed('activation_cache')
+  def freeze_backbone(self, classes_group_idx):
+    # The frozen stages are taken from the best network of the previous group, which is also
+    # the teacher of the distillation methods, so student and teacher share the cached activations.
+    stage = self.FROZEN_STAGE
+    for name in FROZEN_STAGES[stage]:
+      getattr(self.net, name).load_state_dict(getattr(self.best_net, name).state_dict())
+    freeze_stages(self.net, stage)
+
+    images_dl = self.train_dl[classes_group_idx]
+    path = None
+    if self.ACTIVATION_DIR is not None:
+      os.makedirs(self.ACTIVATION_DIR, exist_ok=True)
+      # one file per run and rank, the runs of a sweep and the ranks of a node can share the directory
+      seed = self.SEED if self.SEED is not None else torch.initial_seed()
+      run = f"{type(self).__name__}_seed{seed}_rank{process_rank()}"
+      path = os.path.join(self.ACTIVATION_DIR, f"activations_{run}_group{classes_group_idx}.npy")
+    self.train_dl[classes_group_idx] = build_activation_cache(self.net, images_dl, stage, self.ACTIVATION_VIEWS, self.DEVICE, path,
+                                                              self.replay_activations())
+    print(f"Cached {stage} activations of {len(self.train_dl[classes_group_idx].dataset)} samples")
+    return images_dl
+
+  def replay_activations(self):
+    # (activations, labels) at the frozen stage replayed with the group data, for the rehearsal methods
+    return None
+
+  @contextmanager
+  def frozen_input(self, frozen):
+    # the student, and the teacher of the distillation methods, read activations instead of images
+    nets = [self.net, getattr(self, 'old_net', None)] if frozen else []
+    for net in nets:
+      if net is not None: set_input_stage(net, self.FROZEN_STAGE)
+    try:
+      yield
+    finally:
+      for net in nets:
+        if net is not None: set_input_stage(net, None)
+
+  def profiled(self, classes_group_idx, epoch):
+    if self.PROFILE_WINDOW != (classes_group_idx, epoch):
+      return nullcontext()
+    return profile_window(self.timers, self.PROFILE_TRACE)
+
+  def group_profile(self, classes_group_idx):
+    # summary of the phases of the group, printed and appended to PROFILE_LOG; the timers restart
+    summary = self.timers.summary()
+    print_summary(summary, f"Group {classes_group_idx + 1} time")
+    if self.PROFILE_LOG is not None and is_main_process():
+      append_summary(summary, self.PROFILE_LOG, method=type(self).__name__, seed=self.SEED, group=classes_group_idx)
+    self.timers.reset()
+    return summary
+
+  def apply_thread_settings(self, settings):
+    # the evaluation settings are the default of the process, training epochs switch to the training ones
+    self.thread_settings = settings
+    torch.set_num_threads(settings['eval']['threads'])
+    self.NUM_WORKERS = settings['train']['workers']
+    for dataloader in self.train_dl:
+      dataloader.num_workers = settings['train']['workers']
+    self.evaluation.batch_size = settings['eval']['batch_size']
+    self.evaluation.num_workers = settings['eval']['workers']
+
+  @contextmanager
+  def training_threads(self):
+    if self.thread_settings is None:
+      yield
+      return
+    torch.set_num_threads(self.thread_settings['train']['threads'])
+    try:
+      yield
+    finally:
+      torch.set_num_threads(self.thread_settings['eval']['threads'])
+
+  def set_view_epoch(self, classes_group_idx):
+    # datasets drawing fixed augmentation views (see model.teacher) use the view of this epoch
+    dataset = self.train_dl[classes_group_idx].dataset
+    if hasattr(dataset, 'set_epoch'):
+      dataset.set_epoch(self.view_epoch)
+      self.view_epoch += 1
+
+  def check_autocast(self, classes_group_idx):
+    # the batch is drawn without consuming the random state of the run
+    with torch.random.fork_rng(devices=[]):
+      _, images, labels = next(iter(self.validation_dl[classes_group_idx]))
+    images, labels = images.to(self.DEVICE), labels.to(self.DEVICE)
+    loss_error, changed = bf16_batch_check(self.net, self.criterion, images, self.onehot_encoding(labels), torch.device(self.DEVICE).type)
+    print(f"bf16 autocast: loss error {loss_error:.4f}, changed predictions {changed:.4f}")
+    rejected = not all(math.isfinite(error) and error <= self.BF16_TOLERANCE for error in (loss_error, changed))
+    if self.DISTRIBUTED:
+      rejected = broadcast_object(rejected)
+    if rejected:
+      warnings.warn(f"bf16 autocast exceeds the tolerance {self.BF16_TOLERANCE}, falling back to fp32", RuntimeWarning)
+      self.BF16_AUTOCAST = False
+
+  def autocast(self):
+    # Parameters and optimizer state stay fp32; the convolutions and linear layers run in bf16
+    # and the autocast policy computes the loss functions in fp32.
+    return torch.autocast(torch.device(self.DEVICE).type, dtype=torch.bfloat16, enabled=self.BF16_AUTOCAST)
+
   def train_epoch(self, classes_group_idx):
     self.net.train()
-    running_loss = 0
-    running_corrects = 0
-    total = 0
-    for _, images, labels in self.train_dl[classes_group_idx]:
+    self.set_view_epoch(classes_group_idx)
+    metrics = RunningMetrics(self.DEVICE)
+    for _, images, labels in self.timers.iterate(self.train_dl[classes_group_idx], 'train'):
       self.optimizer.zero_grad()
 
       images = images.to(self.DEVICE)
       labels = labels.to(self.DEVICE)
 
       one_hot_labels = self.onehot_encoding(labels) 
-      output = self.net(images)    
-      loss = self.criterion(output, one_hot_labels)
+      with self.autocast():
+        output = self.net(images)    
+        loss = self.criterion(output, one_hot_labels)
 
-      running_loss += loss.item()
       _, preds = torch.max(output.data, 1)
-      running_corrects += torch.sum(preds == labels.data).data.item()
-      total += labels.size(0)
+      metrics.update(preds, labels.data, loss)
       
       loss.backward()
       self.optimizer.step()
       
     else:
-      epoch_loss = running_loss/len(self.train_dl[classes_group_idx])
-      epoch_acc = running_corrects/float(total)
+      epoch_loss = metrics.mean_loss(len(self.train_dl[classes_group_idx]))
+      epoch_acc = metrics.accuracy()
       
     return epoch_loss, epoch_acc
   
+  @timed('validation')
   def validate(self, classes_group_idx):
-    self.net.train(False)
-    running_loss = 0
-    running_corrects = 0
-    total = 0
-
-    for _, images, labels in self.validation_dl[classes_group_idx]:
-      total += labels.size(0)
-      self.optimizer.zero_grad()
+    net = self.evaluation.model(self.net, fixed=False)
+    dataloader = self.evaluation.loader(self.validation_dl[classes_group_idx])
+    if self.DISTRIBUTED:
+      dataloader = self.validation_shard(classes_group_idx, dataloader)
+    metrics = RunningMetrics(self.DEVICE)
 
-      images = images.to(self.DEVICE)
-      labels = labels.to(self.DEVICE)
+    with torch.inference_mode():
+      for _, images, labels in self.timers.iterate(dataloader, 'validation'):
+        images = images.to(self.DEVICE)
+        labels = labels.to(self.DEVICE)
 
-      one_hot_labels = self.onehot_encoding(labels) 
-      output = self.net(images)     
-      loss = self.criterion(output, one_hot_labels)
+        one_hot_labels = self.onehot_encoding(labels) 
+        output = net(images)     
+        loss = self.criterion(output, one_hot_labels)
 
-      running_loss += loss.item()
-      _, preds = torch.max(output.data, 1)
-      running_corrects += torch.sum(preds == labels.data).data.item()
+        _, preds = torch.max(output.data, 1)
+        metrics.update(preds, labels.data, loss)
       
-    else:
-      val_loss = running_loss/len(self.validation_dl[classes_group_idx])
-      val_accuracy = running_corrects / float(total)
+    if self.DISTRIBUTED:
+      metrics.all_reduce(len(dataloader))
+    val_loss = metrics.mean_loss(len(dataloader))
+    val_accuracy = metrics.accuracy()
 
     return val_loss, val_accuracy
 
+  def validation_shard(self, classes_group_idx, dataloader):
+    # validation samples of this rank, the loader is built once per group
+    shard = self.validation_shards.get(classes_group_idx)
+    if shard is None or shard[0] is not dataloader:
+      shard = (dataloader, split_loader(dataloader))
+      self.validation_shards[classes_group_idx] = shard
+    return shard[1]
+
+  @timed('test')
   def test(self, classes_group_idx):
-    self.best_net.train(False)
-    running_corrects = 0
-    total = 0
-
-    all_preds = torch.tensor([])
-    all_preds = all_preds.type(torch.LongTensor)
-    all_targets = torch.tensor([])
-    all_targets = all_targets.type(torch.LongTensor)
+    net = self.evaluation.model(self.best_net)
+    dataloader = self.evaluation.loader(self.test_dl[classes_group_idx])
+    metrics = RunningMetrics(self.DEVICE)
+    results = ResultCollector(loader_size(dataloader), self.DEVICE, targets=torch.long, preds=torch.long)
     
-    for _, images, labels in self.test_dl[classes_group_idx]:
-      images = images.to(self.DEVICE)
-      labels = labels.to(self.DEVICE)
-      total += labels.size(0)
+    with torch.inference_mode():
+      for _, images, labels in self.timers.iterate(dataloader, 'test'):
+        images = images.to(self.DEVICE)
+        labels = labels.to(self.DEVICE)
 
-      outputs = self.best_net(images)
-      
-      _, preds = torch.max(outputs.data, 1)
-      running_corrects += torch.sum(preds == labels.data).data.item()
+        outputs = net(images)
+        
+        _, preds = torch.max(outputs.data, 1)
+        metrics.update(preds, labels.data)
 
-      all_targets = torch.cat((all_targets.to(self.DEVICE), labels.to(self.DEVICE)), dim=0)
-      all_preds = torch.cat((all_preds.to(self.DEVICE), preds.to(self.DEVICE)), dim=0)
+        results.add('targets', labels)
+        results.add('preds', preds)
 
-    else:
-      accuracy = running_corrects / float(total)  
+    accuracy = metrics.accuracy()
 
-    return accuracy, all_targets, all_preds
+    return accuracy, results.result('targets'), results.result('preds')
 
   def add_output_nodes(self):
     self.net.fc = nn.Linear(self.net.fc.in_features, self.net.fc.out_features + 10, bias=False)
     self.net.fc.weight.data[:self.net.fc.out_features] = self.net.fc.weight.data
+    # only the new head is compiled, the stages keep their graphs
+    self.compiled(self.net)
+
+  @property
+  def memory_format(self):
+    return torch.channels_last if self.CHANNELS_LAST else torch.contiguous_format
+
+  def formatted(self, net):
+    # converted once, deep copies keep the memory format of the weights
+    if self.CHANNELS_LAST:
+      net.to(memory_format=torch.channels_last)
+    return net
+
+  def format_loaders(self):
+    if self.CHANNELS_LAST:
+      for loaders in (self.train_dl, self.validation_dl, self.test_dl):
+        for i in range(len(loaders)):
+          loaders[i] = channels_last_loader(loaders[i])
+
+  def compiled(self, net):
+    # already compiled modules are left as they are, deep copies are compiled again
+    if self.COMPILE:
+      if self.COMPILE_CACHE_DIR is not None:
+        enable_compile_cache(self.COMPILE_CACHE_DIR)
+      compile_network(net, self.COMPILE_BACKEND)
+    return net
 
   def onehot_encoding(self, labels):   
     enc_labels = torch.eye(self.net.fc.out_features)[labels]
@@ -0,0 +1,126 @@
+import os
+import time
+import platform
+from copy import deepcopy
+import torch
+import torch.optim as optim
+from torch.utils.data import DataLoader
+from model.checkpoints import config_hash
+from model.sweep import load_store, save_store
+
+# Thread and DataLoader worker settings of a machine. The intra-op threads of PyTorch and the
+# loader workers compete for the same cores, and the best split differs between training
+# (backward passes, augmentation in the workers) and evaluation (forward only, larger batches).
+# tune_threads times a few training steps and evaluation batches of the first group under
+# candidate (threads, workers) and evaluation batch size configurations, keeps the fastest of
+# each phase and stores them in a JSON file under a key of the machine profile (CPU model, cores,
+# PyTorch version, device, batch size), so later runs on the same kind of machine reuse them.
+
+
+def available_cores():
+  return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+
+def cpu_model():
+  try:
+    with open('/proc/cpuinfo') as f:
+      for line in f:
+        if line.startswith('model name'):
+          return line.split(':', 1)[1].strip()
+  except OSError:
+    pass
+  return platform.processor()
+
+
+def machine_profile(trainer):
+  return {
+    'cpu': cpu_model(),
+    'machine': platform.machine(),
+    'cores': available_cores(),
+    'torch': torch.__version__,
+    'device': str(trainer.DEVICE),
+    'batch_size': trainer.train_dl[0].batch_size
+  }
+
+
+def candidate_settings(cores, batch_size):
+  threads = sorted({t for t in (1, 2, 4, 8, 16, 32, 64) if t < cores} | {cores})
+  workers = [w for w in (0, 2, 4, 8) if w < cores or w == 0]
+  train = [{'threads': t, 'workers': w} for t in threads for w in workers if t + w <= max(cores, 2)]
+  evaluation = [dict(s, batch_size=b) for s in train for b in (batch_size, 2 * batch_size, 4 * batch_size)]
+  return train, evaluation
+
+
+def time_batches(dataloader, step, num_batches):
+  # seconds per sample over num_batches batches, after one warm-up batch (worker start-up, allocations)
+  samples, start = 0, None
+  for i, (_, images, labels) in enumerate(dataloader):
+    if i == 1:
+      start = time.perf_counter()
+    step(images, labels)
+    if i >= 1:
+      samples += images.size(0)
+    if i == num_batches:
+      break
+  if start is None or samples == 0:
+    return float('inf')
+  return (time.perf_counter() - start) / samples
+
+
+def benchmark_train(trainer, settings, num_batches):
+  net = deepcopy(trainer.net).to(trainer.DEVICE)
+  net.train()
+  optimizer = optim.SGD(net.parameters(), lr=0.0)
+  dataloader = trainer.train_dl[0]
+  loader = DataLoader(dataloader.dataset, batch_size=dataloader.batch_size, shuffle=True,
+                      num_workers=settings['workers'], collate_fn=dataloader.collate_fn, drop_last=True)
+
+  def step(images, labels):
+    optimizer.zero_grad()
+    output = net(images.to(trainer.DEVICE))
+    loss = trainer.criterion(output, trainer.onehot_encoding(labels.to(trainer.DEVICE)))
+    loss.backward()
+    optimizer.step()
+
+  torch.set_num_threads(settings['threads'])
+  return time_batches(loader, step, num_batches)
+
+
+def benchmark_eval(trainer, settings, num_batches):
+  # a copy, the network of the trainer keeps its mode
+  net = deepcopy(trainer.net).to(trainer.DEVICE).train(False)
+  dataloader = trainer.validation_dl[0]
+  loader = DataLoader(dataloader.dataset, batch_size=settings['batch_size'], shuffle=False,
+                      num_workers=settings['workers'], collate_fn=dataloader.collate_fn)
+
+  def step(images, labels):
+    with torch.inference_mode():
+      net(images.to(trainer.DEVICE))
+
+  torch.set_num_threads(settings['threads'])
+  return time_batches(loader, step, num_batches)
+
+
+def tune_threads(trainer, path, num_batches=5, retune=False):
+  """
+  Returns the {'train': ..., 'eval': ...} settings of the machine, from the profile file
+  `path` or benchmarked when the machine has no entry yet (or `retune`), and applies
+  them to `trainer` (see Trainer.apply_thread_settings).
+  """
+  profile = machine_profile(trainer)
+  key = config_hash(profile)[:16]
+  store = load_store(path)
+  if key not in store or retune:
+    previous = torch.get_num_threads()
+    train, evaluation = candidate_settings(profile['cores'], profile['batch_size'])
+    times = {'train': [benchmark_train(trainer, s, num_batches) for s in train],
+             'eval': [benchmark_eval(trainer, s, num_batches) for s in evaluation]}
+    torch.set_num_threads(previous)
+    best_train = train[min(range(len(train)), key=times['train'].__getitem__)]
+    best_eval = evaluation[min(range(len(evaluation)), key=times['eval'].__getitem__)]
+    store[key] = {'profile': profile, 'train': best_train, 'eval': best_eval}
+    save_store(store, path)
+    print(f"Tuned threads for {profile['cpu']} ({profile['cores']} cores): train {best_train}, eval {best_eval}")
+  settings = {'train': store[key]['train'], 'eval': store[key]['eval']}
+  trainer.apply_thread_settings(settings)
+  return settings
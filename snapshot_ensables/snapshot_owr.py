@@ -17,6 +17,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.optim.lr_scheduler import LambdaLR
 from copy import deepcopy
+from contextlib import nullcontext
 
 from ._base import BaseModule, BaseClassifier, BaseRegressor
 from ._base import torchensemble_model_doc
@@ -106,6 +107,40 @@ class _BaseSnapshotEnsemble(BaseModule):
 
         self.estimators_ = nn.ModuleList()
         self.old_ensemble = None
+        # dtype of the autocast of the training forward passes (e.g.
+        # torch.bfloat16 on CPU), ``None`` trains in full precision
+        self.autocast_dtype = None
+        # memory format of the estimators (e.g. torch.channels_last, matching
+        # the batches of the loaders), applied once when they are created
+        self.memory_format = torch.preserve_format
+        # PhaseTimer of the trainer (see model/profiling.py) timing the data
+        # loading, teacher and validation phases of fit, ``None`` disables it
+        self.phase_timer = None
+
+    def __getstate__(self):
+        """State without the phase timer (thread-local state), for copies
+        and checkpoints of the ensemble. The memory format is stored by name,
+        torch.save cannot pickle it."""
+        state = super().__getstate__()
+        state["phase_timer"] = None
+        state["memory_format"] = str(self.memory_format).replace("torch.", "")
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.memory_format = getattr(torch, self.memory_format)
+
+    def _phase(self, name):
+        """Context of the phase ``name`` of the phase timer, if any."""
+        if self.phase_timer is None:
+            return nullcontext()
+        return self.phase_timer.phase(name)
+
+    def _batches(self, dataloader, name):
+        """Batches of ``dataloader``, timed as the phase ``name``."""
+        if self.phase_timer is None:
+            return dataloader
+        return self.phase_timer.iterate(dataloader, name)
 
     def _validate_parameters(self, lr_clip, epochs, log_interval):
         """Validate hyper-parameters on training the ensemble."""
@@ -244,7 +279,9 @@ class SnapshotEnsembleOWRClassifier(_BaseSnapshotEnsemble, BaseClassifier):
         self.n_outputs = self._decide_n_outputs(train_loader)
         self.estimators_ = nn.ModuleList()
 
-        estimator = self._make_estimator().to(self.device)
+        estimator = self._make_estimator().to(
+            self.device, memory_format=self.memory_format
+        )
 
         # Set the optimizer and scheduler
         optimizer = set_module.set_optimizer(
@@ -264,7 +301,9 @@ class SnapshotEnsembleOWRClassifier(_BaseSnapshotEnsemble, BaseClassifier):
         estimator.train()
         for epoch in range(epochs):
                 
-            for batch_idx, (_,data,target) in enumerate(train_loader):
+            for batch_idx, (_, data, target) in enumerate(
+                self._batches(train_loader, "train")
+            ):
                 data = data.to(self.device)
                 target = target.to(self.device)
 
@@ -275,12 +314,17 @@ class SnapshotEnsembleOWRClassifier(_BaseSnapshotEnsemble, BaseClassifier):
                 optimizer = self._clip_lr(optimizer, lr_clip)
 
                 optimizer.zero_grad()
-                output = estimator(data)
-                #loss = criterion(output, target)
-                
-
-
-                loss = self.compute_loss(output, data, target, classes_group_idx)
+                with torch.autocast(
+                    self.device.type,
+                    dtype=self.autocast_dtype,
+                    enabled=self.autocast_dtype is not None,
+                ):
+                    output = estimator(data)
+                    #loss = criterion(output, target)
+
+                    loss = self.compute_loss(
+                        output, data, target, classes_group_idx
+                    )
                 loss.backward()
 
                 optimizer.step()
@@ -323,7 +367,9 @@ class SnapshotEnsembleOWRClassifier(_BaseSnapshotEnsemble, BaseClassifier):
             if counter % n_iters_per_estimator == 0:
 
                 # Generate and save the snapshot
-                snapshot = self._make_estimator().to(self.device)
+                snapshot = self._make_estimator().to(
+                    self.device, memory_format=self.memory_format
+                )
                 snapshot.load_state_dict(estimator.state_dict())
                 self.estimators_.append(snapshot)
 
@@ -333,10 +379,12 @@ class SnapshotEnsembleOWRClassifier(_BaseSnapshotEnsemble, BaseClassifier):
             # Validation after each snapshot model being generated
             if test_loader and counter % n_iters_per_estimator == 0:
                 self.eval()
-                with torch.no_grad():
+                with torch.no_grad(), self._phase("validation"):
                     correct = 0
                     total = 0
-                    for _,data,target in test_loader:
+                    for _, data, target in self._batches(
+                        test_loader, "validation"
+                    ):
                         data = data.to(self.device)
                         target = target.to(self.device)
                         #data, target = io.split_data_target(elem, self.device)
@@ -386,7 +434,8 @@ class SnapshotEnsembleOWRClassifier(_BaseSnapshotEnsemble, BaseClassifier):
             self.old_ensemble.eval()
             self.old_ensemble.to(self.device)    
             sigmoid = nn.Sigmoid().to(self.device)
-            old_net_output = sigmoid(self.old_ensemble(images))[:, :num_classes-10]
+            with self._phase("teacher"):
+                old_net_output = sigmoid(self.old_ensemble(images))[:, :num_classes-10]
             dist_loss = dist_criterion(output[:,:num_classes-10].to(self.device), old_net_output.to(self.device), torch.ones(images.shape[0]).to(self.device))
             class_loss = class_criterion(output.to(self.device), labels.to(self.device))
             loss = dist_loss + class_loss